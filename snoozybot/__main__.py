@@ -1,12 +1,14 @@
 import asyncio
 import logging
 import sys
+from multiprocessing.connection import Connection
 
 import snoozybot.chat as chat
 import snoozybot.database.lifecycle as database
 import snoozybot.discord_bot.lifecycle as discord_bot
+import snoozybot.supervisor as supervisor
 from snoozybot.config.env import envConfig
-from snoozybot.utils import get_client_session
+from snoozybot.http_client import http_client
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -15,20 +17,37 @@ if envConfig.short_logs:
     logging.basicConfig(format="%(levelname)-4s %(name)s: %(message)s", level="INFO", stream=sys.stdout)
 
 
-async def run():
+async def run(partition: discord_bot.BotPartition | None = None, health_conn: Connection | None = None):
+    health_task: asyncio.Task | None = None
     try:
         await database.start()
         await chat.start()
-        await discord_bot.start()
+        if health_conn:
+            health_task = asyncio.create_task(supervisor.report_health(health_conn))
+        await discord_bot.start(partition)
     finally:
+        if health_task:
+            health_task.cancel()
         await discord_bot.stop()
         await chat.stop()
         await database.stop()
-        await get_client_session().close()
+        await http_client.close()
+
+
+def run_worker(partition: discord_bot.BotPartition, primary: bool, health_conn: Connection):
+    """Entry point of worker processes started in supervisor mode."""
+    if not primary:
+        # Webhook receivers listen on fixed ports, so only one worker can run them. Others fall back to polling.
+        envConfig.twitch_eventsub_port = None
+        envConfig.youtube_websub_port = None
+    supervisor.run_worker(run(partition, health_conn))
 
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(run())
-    except KeyboardInterrupt:
-        pass
+    if envConfig.workers:
+        supervisor.supervise(run_worker)
+    else:
+        try:
+            asyncio.run(run())
+        except KeyboardInterrupt:
+            pass
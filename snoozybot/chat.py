@@ -1,18 +1,28 @@
-import google.generativeai as genai
-from openai import AsyncOpenAI
+"""
+Clients of the AI chat providers. Their SDKs are slow to import, and most bots never use them, so they are imported
+and set up on first use rather than on startup.
+"""
+import types
+import typing
+
+from pydantic import SecretStr
 
 from snoozybot.config.provider import get_secret_configs
 
-_openai_clients: dict[int, AsyncOpenAI] = {}
+if typing.TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+_openai_keys: dict[int, SecretStr] = {}
+_openai_clients: dict[int, 'AsyncOpenAI'] = {}
+_gemini_key: SecretStr | None = None
+_gemini: types.ModuleType | None = None
 
 
 async def start():
-    openai_keys = await get_secret_configs('secret.openai.apikey')
-    for guild, api_key in openai_keys.items():
-        chat_client = AsyncOpenAI(api_key=api_key.get_secret_value())
-        _openai_clients[guild] = chat_client
+    global _gemini_key
+    _openai_keys.update(await get_secret_configs('secret.openai.apikey'))
     gemini_keys = await get_secret_configs('secret.gemini.apikey')
-    genai.configure(api_key=next(iter(gemini_keys.values())).get_secret_value())
+    _gemini_key = next(iter(gemini_keys.values()), None)
 
 
 async def stop():
@@ -20,5 +30,27 @@ async def stop():
         await chat_client.close()
 
 
-def get_openai(guild_id: int) -> AsyncOpenAI:
+def get_openai(guild_id: int) -> 'AsyncOpenAI':
+    if guild_id not in _openai_clients:
+        from openai import AsyncOpenAI
+        _openai_clients[guild_id] = AsyncOpenAI(api_key=_openai_keys[guild_id].get_secret_value())
     return _openai_clients[guild_id]
+
+
+def get_gemini() -> types.ModuleType:
+    """The google.generativeai module, configured with our API key."""
+    global _gemini
+    if _gemini is None:
+        if _gemini_key is None:
+            raise ValueError('Gemini is not set up: secret.gemini.apikey is not configured.')
+        import google.generativeai as genai
+        genai.configure(api_key=_gemini_key.get_secret_value())
+        _gemini = genai
+    return _gemini
+
+
+def get_server_errors() -> tuple[type[Exception], ...]:
+    """Errors of the providers that mean they're temporarily unavailable."""
+    import google.api_core.exceptions
+    import openai
+    return openai.InternalServerError, google.api_core.exceptions.InternalServerError
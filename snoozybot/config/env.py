@@ -4,8 +4,20 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class EnvironmentConfig(BaseSettings):
     database_url: SecretStr = Field(...)
+    database_replica_url: SecretStr | None = Field(None)  # read-only ORM queries go here when set
+    db_replica_max_lag: float = Field(5)  # seconds; reads go to the primary while the replica lags more
     short_logs: bool = Field(False)
     log_level: str | int = Field("INFO")
+    db_pool_min_size: int = Field(1)
+    db_pool_max_size: int = Field(10)
+    db_command_timeout: float | None = Field(None)  # seconds
+    db_statement_cache_size: int = Field(100)  # prepared statements per connection; 0 behind pgbouncer
+    db_slow_query_ms: int = Field(500)  # queries and connection waits longer than this are logged
+    profile_startup: bool = Field(False)  # log a profile of creating and connecting the bots
+    workers: bool = Field(False)  # run each discord token's bot in its own process (POSIX only)
+    twitch_eventsub_port: int | None = Field(None)  # enables twitch eventsub webhooks when set
+    youtube_websub_port: int | None = Field(None)  # enables youtube websub push notifications when set
+    bsky_jetstream_url: str | None = Field(None)  # e.g. wss://jetstream2.us-east.bsky.network/subscribe
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -69,3 +69,7 @@ presence_streaming_notif_title_template = ConfigValue[str]('presence.streaming.n
 
 report_channel_id = ConfigValue[int]('report.channel_id')
 report_message = ConfigValue[str]('report.message', '')
+
+# Set on any guild of a token (or globally) to shard that token's bot; in worker mode shards can be split into processes
+discord_shard_count = ConfigValue[int]('discord.shard_count')
+discord_shards_per_worker = ConfigValue[int]('discord.shards_per_worker')
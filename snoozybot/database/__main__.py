@@ -0,0 +1,58 @@
+"""
+Database administration, run outside of the bot:
+    python -m snoozybot.database status                       - show the schema version
+    python -m snoozybot.database migrate                      - apply pending migrations
+    python -m snoozybot.database import-quotes GUILD_ID FILE  - import quotes from a .jsonl or .csv file
+    python -m snoozybot.database export-quotes GUILD_ID FILE  - export all quotes of a guild to a .jsonl or .csv file
+"""
+import argparse
+import asyncio
+import logging
+import pathlib
+
+from . import lifecycle, migrations, quote_transfer
+
+logger = logging.getLogger(__name__)
+
+
+async def main(args: argparse.Namespace) -> None:
+    await lifecycle.start(check_schema=args.command not in ('status', 'migrate'))
+    try:
+        if args.command == 'migrate':
+            await migrations.migrate()
+        elif args.command == 'import-quotes':
+            with args.file.open(encoding='utf-8-sig', newline='') as file:
+                read, inserted = await quote_transfer.import_quotes(
+                    args.guild_id, quote_transfer.read_quotes(file, _get_format(args.file)), args.added_by)
+            logger.info('Imported %d new quotes, skipped %d that already exist.', inserted, read - inserted)
+        elif args.command == 'export-quotes':
+            with args.file.open('wb') as file:
+                count = await quote_transfer.export_quotes(args.guild_id, _get_format(args.file), file)
+            logger.info('Exported %d quotes.', count)
+        else:
+            logger.info('Database schema is at version %d, latest is %d.',
+                        await migrations.get_version(), migrations.LATEST_VERSION)
+    finally:
+        await lifecycle.stop()
+
+
+def _get_format(path: pathlib.Path) -> str:
+    format = path.suffix.lstrip('.').lower()
+    if format not in quote_transfer.FORMATS:
+        raise SystemExit(f'Unsupported file type {path.suffix!r}, use one of: {", ".join(quote_transfer.FORMATS)}')
+    return format
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m snoozybot.database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status')
+    commands.add_parser('migrate')
+    for command in ('import-quotes', 'export-quotes'):
+        subparser = commands.add_parser(command)
+        subparser.add_argument('guild_id', type=int)
+        subparser.add_argument('file', type=pathlib.Path)
+    commands.choices['import-quotes'].add_argument(
+        '--added-by', type=int, default=0, help='user ID recorded as having added quotes without an added_by')
+    logging.basicConfig(format="%(levelname)-4s %(name)s: %(message)s", level="INFO")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,148 @@
+"""
+Upcoming birthdays of guild members. Each member's next birthday is stored in UTC, at midnight in the timezone the user
+set, so it has to be computed again whenever the user changes their timezone.
+"""
+import asyncio
+import calendar
+import heapq
+import logging
+from datetime import date, datetime, time
+from typing import Collection, NamedTuple
+
+import pytz
+import tortoise.transactions
+
+from snoozybot.database.models import GuildMember, User
+from snoozybot.exceptions import UserError
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ('guild_id', 'user_id', 'birthday_month', 'birthday_day', 'next_birthday_utc')
+
+
+class UpcomingBirthday(NamedTuple):
+    guild_id: int
+    user_id: int
+    birthday_month: int
+    birthday_day: int
+    next_birthday_utc: datetime
+
+
+class BirthdayCalendar:
+    """
+    In-memory index of everyone's next birthday, keyed by guild then user. The database remains the source of truth;
+    this is loaded once on startup and updated whenever this process changes a member's next_birthday_utc. Other
+    processes may change birthdays too, so call refresh_due to read the birthdays that are due from the database before
+    acting on them.
+    """
+
+    def __init__(self) -> None:
+        self._birthdays: dict[int, dict[int, UpcomingBirthday]] = {}
+        self._changed = asyncio.Event()
+
+    async def load(self, guilds: Collection[int]) -> None:
+        members = GuildMember.filter(guild_id__in=guilds, next_birthday_utc__isnull=False).only(*_FIELDS)
+        count = 0
+        async for member in members:
+            self.set(member)
+            count += 1
+        logger.info('Loaded %d upcoming birthdays for guilds %s.', count, guilds)
+
+    def set(self, member: GuildMember | UpcomingBirthday) -> None:
+        if member.next_birthday_utc is None:
+            self.remove(member.guild_id, member.user_id)
+            return
+        birthday = UpcomingBirthday(
+            member.guild_id, member.user_id, member.birthday_month, member.birthday_day, member.next_birthday_utc)
+        guild_birthdays = self._birthdays.setdefault(member.guild_id, {})
+        if guild_birthdays.get(member.user_id) != birthday:
+            guild_birthdays[member.user_id] = birthday
+            self._notify()
+
+    def remove(self, guild_id: int, user_id: int) -> None:
+        if self._birthdays.get(guild_id, {}).pop(user_id, None):
+            self._notify()
+
+    def upcoming(self, guild_id: int, after: datetime, limit: int) -> list[UpcomingBirthday]:
+        """Returns the next few birthdays at or after the given time, soonest first."""
+        birthdays = (b for b in self._birthdays.get(guild_id, {}).values() if b.next_birthday_utc >= after)
+        return heapq.nsmallest(limit, birthdays, key=lambda b: b.next_birthday_utc)
+
+    def due(self, guilds: Collection[int], now: datetime) -> list[UpcomingBirthday]:
+        return [b for guild in guilds for b in self._birthdays.get(guild, {}).values() if b.next_birthday_utc <= now]
+
+    async def refresh_due(self, guilds: Collection[int], now: datetime) -> list[UpcomingBirthday]:
+        """
+        Reads the birthdays that are due from the database, including the ones another process has moved to an earlier
+        time, and returns them. Birthdays that were due in the calendar but were moved to later or removed since are
+        updated too.
+        """
+        stale = {(b.guild_id, b.user_id) for b in self.due(guilds, now)}
+        due: list[UpcomingBirthday] = []
+        async for member in GuildMember.filter(guild_id__in=guilds, next_birthday_utc__lte=now).only(*_FIELDS):
+            self.set(member)
+            due.append(self._birthdays[member.guild_id][member.user_id])
+            stale.discard((member.guild_id, member.user_id))
+        for guild_id, user_id in stale:
+            member = await GuildMember.filter(guild_id=guild_id, user_id=user_id).only(*_FIELDS).first()
+            if member is None:
+                self.remove(guild_id, user_id)
+            else:
+                self.set(member)
+        return due
+
+    def next_due(self, guilds: Collection[int], now: datetime) -> datetime | None:
+        return min((b.next_birthday_utc for guild in guilds for b in self._birthdays.get(guild, {}).values()
+                    if b.next_birthday_utc > now), default=None)
+
+    async def wait_for_change(self, timeout: float | None) -> None:
+        """Wait until any birthday is changed, or until timeout (in seconds) is reached."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _notify(self) -> None:
+        # Every bot's scheduler may be waiting on this; wake all of them, then start a fresh event for the next wait.
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+birthdays = BirthdayCalendar()
+
+
+def _get_birthday_date(year: int, month: int, day: int) -> date:
+    if month == 2 and day == 29 and not calendar.isleap(year):
+        # Celebrate leap day birthdays on the last day of February in other years
+        day = 28
+    return date(year, month, day)
+
+
+async def get_next_birthday_utc(user_id: int, month: int, day: int) -> datetime:
+    # Get current date in user's timezone
+    user = await User.get_or_none(user_id=user_id)
+    if not user or not user.timezone:
+        raise UserError("You have not set a timezone for yourself. Please set a timezone with /timezone "
+                        "first so I can properly understand your birthday.")
+    tz = pytz.timezone(user.timezone)
+    today = datetime.now(tz).date()
+    # Determine if next birthday is in current year or next year
+    next_birthday = _get_birthday_date(today.year, month, day)
+    if next_birthday <= today:
+        next_birthday = _get_birthday_date(today.year + 1, month, day)
+    birthday_local = tz.normalize(tz.localize(datetime.combine(next_birthday, time())))
+    # Convert back to utc
+    birthday_utc = birthday_local.astimezone(pytz.utc)
+    return birthday_utc
+
+
+async def refresh_user_birthdays(user_id: int) -> None:
+    """Recompute a user's next birthday in every guild, e.g. after their timezone has changed."""
+    async with tortoise.transactions.in_transaction('default') as tx:
+        members = await GuildMember.select_for_update().using_db(tx).filter(
+            user_id=user_id, birthday_month__isnull=False, birthday_day__isnull=False)
+        for member in members:
+            member.next_birthday_utc = await get_next_birthday_utc(
+                member.user_id, member.birthday_month, member.birthday_day)
+            await member.save(using_db=tx, update_fields=['next_birthday_utc'])
+            birthdays.set(member)
@@ -1,9 +1,7 @@
 import datetime
 from typing import Any
 
-from pypika_tortoise import CustomFunction
 from tortoise import Model
-from tortoise.expressions import Function
 from tortoise.fields import Field
 
 
@@ -57,7 +55,3 @@ class DatetimeField(Field, datetime.datetime):
             value = datetime.datetime.fromisoformat(value)
         self.validate(value)
         return value
-
-
-class Random(Function):
-    database_func = CustomFunction("random")
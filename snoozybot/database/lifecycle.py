@@ -1,16 +1,49 @@
+import asyncio
+import typing
+
 import tortoise
+from tortoise.backends.base.config_generator import expand_db_url
 
 from ..config.env import envConfig
-from . import models
+from . import migrations, models, pool, replica
+from .poller_state import flush_all
+
+_tasks: list[asyncio.Task] = []
+
+
+def _get_connection_config(db_url: str) -> dict:
+    connection = expand_db_url(db_url)
+    if connection['engine'] == 'tortoise.backends.asyncpg':
+        connection['engine'] = pool.__name__
+        connection['credentials'].update(
+            minsize=envConfig.db_pool_min_size,
+            maxsize=envConfig.db_pool_max_size,
+            command_timeout=envConfig.db_command_timeout,
+            statement_cache_size=envConfig.db_statement_cache_size,
+        )
+    return connection
 
 
-async def start():
-    await tortoise.Tortoise.init(
-        modules={"models": [models]},
-        db_url=envConfig.database_url.get_secret_value(),
-    )
-    await tortoise.Tortoise.generate_schemas()
+async def start(check_schema: bool = True):
+    config: dict[str, typing.Any] = {
+        'connections': {'default': _get_connection_config(envConfig.database_url.get_secret_value())},
+        'apps': {'models': {'models': [models], 'default_connection': 'default'}},
+    }
+    if envConfig.database_replica_url:
+        config['connections'][replica.CONNECTION] = _get_connection_config(
+            envConfig.database_replica_url.get_secret_value())
+        config['routers'] = [replica.ReplicaRouter]
+    await tortoise.Tortoise.init(config=config)
+    if check_schema:
+        await migrations.check()
+    _tasks.append(asyncio.create_task(pool.log_stats_periodically()))
+    if envConfig.database_replica_url:
+        _tasks.append(asyncio.create_task(replica.monitor_lag()))
 
 
 async def stop():
+    for task in _tasks:
+        task.cancel()
+    _tasks.clear()
+    await flush_all()
     await tortoise.Tortoise.close_connections()
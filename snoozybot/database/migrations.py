@@ -0,0 +1,131 @@
+"""
+Versioned changes to the database schema. The version of the schema is recorded in the database, so that starting the
+bot only has to check it, and pending migrations are applied with `python -m snoozybot.database migrate`.
+
+The first migration creates any missing tables from the current models, so later migrations may find their changes
+already applied on new databases, and must be written to be idempotent (e.g. `ADD COLUMN IF NOT EXISTS`). Indexes added
+by migrations should not also be declared on the models, so that they are always created by the migration.
+"""
+import logging
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+import tortoise
+import tortoise.transactions
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import OperationalError
+from tortoise.utils import generate_schema_for_client
+
+logger = logging.getLogger(__name__)
+
+_MIGRATION_LOCK_ID = 0x736E6F6F7A79  # arbitrary, shared by everything that migrates this database
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    sql: str = ''
+    run: Callable[[BaseDBAsyncClient], Awaitable[None]] | None = None
+    # Migrations run in a transaction, unless they use statements that can't (e.g. CREATE INDEX CONCURRENTLY). These
+    # must be safe to run again, since they may fail halfway.
+    transactional: bool = True
+
+    async def apply(self, connection: BaseDBAsyncClient) -> None:
+        if self.sql:
+            await connection.execute_script(self.sql)
+        if self.run:
+            await self.run(connection)
+
+
+def _create_index_concurrently(name: str, definition: str) -> Callable[[BaseDBAsyncClient], Awaitable[None]]:
+    """Builds an index without blocking writes to the table. An invalid index left by a failed attempt is rebuilt."""
+
+    async def run(connection: BaseDBAsyncClient) -> None:
+        _, rows = await connection.execute_query(
+            'SELECT indisvalid AS valid FROM pg_index WHERE indexrelid = to_regclass($1)', [name])
+        if rows and not rows[0]['valid']:
+            await connection.execute_script(f'DROP INDEX CONCURRENTLY {name};')
+        await connection.execute_script(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};')
+
+    return run
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, 'Create tables', run=lambda connection: generate_schema_for_client(connection, safe=True)),
+    Migration(2, 'Add full text search index on quotes', transactional=False, run=_create_index_concurrently(
+        'quotes_content_search_idx', "ON quotes USING GIN (to_tsvector('english', content))")),
+    Migration(3, 'Add user of scheduled tasks', sql="""
+ALTER TABLE scheduled_tasks ADD COLUMN IF NOT EXISTS user_id BIGINT;
+UPDATE scheduled_tasks SET user_id = (payload->>'user')::BIGINT WHERE user_id IS NULL AND payload ? 'user';
+"""),
+    Migration(4, 'Add index on user of scheduled tasks', transactional=False, run=_create_index_concurrently(
+        'scheduled_tasks_guild_user_idx', 'ON scheduled_tasks (guild_id, user_id, task_type)')),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+class SchemaOutdatedError(Exception):
+    """The database has migrations pending that this version of the bot needs."""
+
+    pass
+
+
+async def get_version() -> int:
+    """The version of the database's schema, or 0 if it was never migrated."""
+    connection = tortoise.Tortoise.get_connection('default')
+    try:
+        _, rows = await connection.execute_query('SELECT max(version) AS version FROM schema_versions')
+    except OperationalError:
+        _, rows = await connection.execute_query("SELECT to_regclass('schema_versions') IS NOT NULL AS exists")
+        if rows[0]['exists']:
+            raise
+        return 0
+    return rows[0]['version'] or 0
+
+
+async def check() -> None:
+    """Make sure that the database schema is up to date. Call this on startup."""
+    version = await get_version()
+    if version < LATEST_VERSION:
+        raise SchemaOutdatedError(f'Database schema is at version {version}, but this version of the bot needs '
+                                  f'version {LATEST_VERSION}. Run `python -m snoozybot.database migrate` first.')
+    if version > LATEST_VERSION:
+        logger.warning('Database schema is at version %d, which is newer than this version of the bot (%d).',
+                       version, LATEST_VERSION)
+
+
+async def migrate() -> None:
+    """Apply all pending migrations."""
+    connection = tortoise.Tortoise.get_connection('default')
+    await connection.execute_script("""
+CREATE TABLE IF NOT EXISTS schema_versions (
+    version INT NOT NULL PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+""")
+    # Hold a lock for the whole run, so that migrating from several places at once doesn't apply anything twice
+    async with connection.acquire_connection() as lock_connection:
+        await lock_connection.execute('SELECT pg_advisory_lock($1)', _MIGRATION_LOCK_ID)
+        try:
+            version = await get_version()
+            pending = [migration for migration in MIGRATIONS if migration.version > version]
+            if not pending:
+                logger.info('Database schema is up to date at version %d.', version)
+            for migration in pending:
+                logger.info('Applying migration %d: %s', migration.version, migration.description)
+                if migration.transactional:
+                    async with tortoise.transactions.in_transaction('default') as transaction:
+                        await migration.apply(transaction)
+                        await _record(transaction, migration)
+                else:
+                    await migration.apply(connection)
+                    await _record(connection, migration)
+        finally:
+            await lock_connection.execute('SELECT pg_advisory_unlock($1)', _MIGRATION_LOCK_ID)
+
+
+async def _record(connection: BaseDBAsyncClient, migration: Migration) -> None:
+    await connection.execute_query('INSERT INTO schema_versions (version, description) VALUES ($1, $2)',
+                                   [migration.version, migration.description])
@@ -101,3 +101,16 @@ class ScheduledTask(Model):
     task_type = fields.IntEnumField(TaskType, null=False)
     process_after = fields.DatetimeField(null=False)
     payload = fields.JSONField(null=False)
+    # The member the task is for, also in the payload. Indexed with the guild by a migration.
+    user_id = fields.BigIntField(null=True)
+
+
+class PollerState(Model):
+    class Meta:
+        table = "poller_states"
+        unique_together = (("poller", "key"),)
+
+    poller = fields.TextField(null=False)
+    key = fields.TextField(null=False)
+    value = fields.JSONField(null=False)
+    updated_at = fields.DatetimeField(null=False, auto_now=True)
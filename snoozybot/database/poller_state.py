@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+import typing
+from datetime import datetime, timedelta
+
+import tortoise
+from tortoise import timezone
+
+from snoozybot.database.models import PollerState
+
+logger = logging.getLogger(__name__)
+
+_stores: list['PollerStateStore'] = []
+_DEFAULT_FLUSH_DELAY = timedelta(seconds=30)
+_DEFAULT_EXPIRE_AFTER = timedelta(days=30)
+
+
+class PollerStateStore:
+    """
+    The high-water marks of a poller (e.g. the last known stream ID of each twitch user), persisted so that a restarted
+    bot can continue from where it left off. Values are kept in memory and must be JSON-serializable; changes are
+    written to the database in batches after a short delay.
+
+    States that have not been used in a long time (e.g. of accounts that are no longer followed) are dropped on load.
+    Reading or setting a state marks it as in use, which is saved now and then even if its value stays the same.
+    """
+
+    def __init__(self, poller: str, flush_delay: timedelta = _DEFAULT_FLUSH_DELAY,
+                 expire_after: timedelta = _DEFAULT_EXPIRE_AFTER) -> None:
+        self._poller = poller
+        self._flush_delay = flush_delay.total_seconds()
+        self._expire_after = expire_after
+        self._values: dict[str, typing.Any] = {}
+        self._saved_at: dict[str, datetime] = {}  # when each state was last marked as in use in the database
+        self._dirty: set[str] = set()
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        _stores.append(self)
+
+    async def load(self) -> None:
+        """Loads the stored states. Only the first call has any effect, so each bot may call this on start."""
+        async with self._load_lock:
+            if self._loaded:
+                return
+            await PollerState.filter(
+                poller=self._poller, updated_at__lt=timezone.now() - self._expire_after,
+            ).delete()
+            for state in await PollerState.filter(poller=self._poller):
+                self._values.setdefault(state.key, state.value)  # anything set before loading is newer
+                self._saved_at.setdefault(state.key, state.updated_at)
+            self._loaded = True
+            logger.info('Loaded %d %s poller states', len(self._values), self._poller)
+
+    def __contains__(self, key: str) -> bool:
+        self._touch(key)
+        return key in self._values
+
+    def __getitem__(self, key: str) -> typing.Any:
+        self._touch(key)
+        return self._values[key]
+
+    def __setitem__(self, key: str, value: typing.Any) -> None:
+        if key in self._values and self._values[key] == value:
+            self._touch(key)
+            return
+        self._values[key] = value
+        self._mark_dirty(key)
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        self._touch(key)
+        return self._values.get(key, default)
+
+    def _touch(self, key: str) -> None:
+        """Marks a state as still in use, saving it again if it was last saved long enough ago to expire soon."""
+        saved_at = self._saved_at.get(key)
+        if saved_at is not None and timezone.now() - saved_at > self._expire_after / 4:
+            self._mark_dirty(key)
+
+    def _mark_dirty(self, key: str) -> None:
+        self._dirty.add(key)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """Writes all changed states to the database."""
+        if not self._dirty:
+            return
+        keys = list(self._dirty)
+        self._dirty.clear()
+        saved_at = timezone.now()
+        try:
+            connection = tortoise.Tortoise.get_connection("default")
+            await connection.execute_query("""
+INSERT INTO poller_states (poller, key, value, updated_at)
+SELECT $1, t.key, t.value::jsonb, CURRENT_TIMESTAMP
+FROM unnest($2::text[], $3::text[]) AS t(key, value)
+ON CONFLICT (poller, key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+""", [self._poller, keys, [json.dumps(self._values[key]) for key in keys]])
+        except Exception:
+            self._dirty.update(keys)  # try again with the next batch
+            raise
+        for key in keys:
+            self._saved_at[key] = saved_at
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._flush_delay)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            # The changes are kept and written along with the next batch
+            logger.exception('Failed to save %s poller states', self._poller)
+
+
+async def flush_all() -> None:
+    """Writes pending changes of all poller states. Call this before closing the database."""
+    for store in _stores:
+        if store._flush_task is not None:
+            store._flush_task.cancel()
+            store._flush_task = None
+        try:
+            await store.flush()
+        except Exception:
+            logger.exception('Failed to save %s poller states', store._poller)
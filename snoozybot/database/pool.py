@@ -0,0 +1,89 @@
+"""
+A tortoise engine for postgres that records how the connection pool is used: how long acquiring a connection waits, how
+many connections are in use, and which queries are slow. Use it with the engine name `snoozybot.database.pool`.
+"""
+import asyncio
+import logging
+import time
+import typing
+from dataclasses import dataclass
+
+import asyncpg
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+
+from snoozybot.config.env import envConfig
+
+logger = logging.getLogger(__name__)
+
+_STATS_LOG_INTERVAL = 600  # seconds
+
+
+@dataclass
+class PoolStats:
+    """Connection pool usage since the last time the stats were logged."""
+    acquires: int = 0
+    total_wait_seconds: float = 0
+    max_wait_seconds: float = 0
+    max_in_use: int = 0
+    queries: int = 0
+    slow_queries: int = 0
+
+    def __str__(self) -> str:
+        mean_wait = self.total_wait_seconds / self.acquires if self.acquires else 0
+        return (f'{self.acquires} acquires, wait mean {mean_wait * 1000:.1f}ms, '
+                f'wait max {self.max_wait_seconds * 1000:.0f}ms, max {self.max_in_use} connections in use, '
+                f'{self.queries} queries, {self.slow_queries} slow')
+
+
+stats = PoolStats()
+
+
+class _InstrumentedPool:
+    """Wraps the asyncpg pool to time acquiring connections. Tortoise only ever awaits acquire."""
+
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self._pool = pool
+
+    async def acquire(self, *, timeout: float | None = None) -> asyncpg.Connection:
+        started = time.perf_counter()
+        connection = await self._pool.acquire(timeout=timeout)
+        waited = time.perf_counter() - started
+        stats.acquires += 1
+        stats.total_wait_seconds += waited
+        stats.max_wait_seconds = max(stats.max_wait_seconds, waited)
+        stats.max_in_use = max(stats.max_in_use, self._pool.get_size() - self._pool.get_idle_size())
+        if waited * 1000 > envConfig.db_slow_query_ms:
+            logger.warning('Waited %.0fms for a database connection, pool max size is %d', waited * 1000,
+                           self._pool.get_max_size())
+        return connection
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._pool, name)
+
+
+class InstrumentedAsyncpgClient(AsyncpgDBClient):
+    async def create_pool(self, **kwargs: typing.Any) -> asyncpg.Pool:
+        return typing.cast(asyncpg.Pool, _InstrumentedPool(await super().create_pool(init=_init_connection, **kwargs)))
+
+
+client_class = InstrumentedAsyncpgClient
+
+
+async def log_stats_periodically() -> None:
+    global stats
+    while True:
+        await asyncio.sleep(_STATS_LOG_INTERVAL)
+        if stats.acquires:
+            logger.info('Database pool: %s', stats)
+        stats = PoolStats()
+
+
+async def _init_connection(connection: asyncpg.Connection) -> None:
+    connection.add_query_logger(_on_query)
+
+
+def _on_query(query: asyncpg.connection.LoggedQuery) -> None:
+    stats.queries += 1
+    if query.elapsed * 1000 > envConfig.db_slow_query_ms:
+        stats.slow_queries += 1
+        logger.warning('Slow query (%.0fms): %s', query.elapsed * 1000, ' '.join(query.query.split())[:500])
@@ -0,0 +1,87 @@
+"""
+Bulk import and export of a guild's quotes, as JSON lines or CSV with the columns user_id, added_by and content. Quotes
+are streamed through COPY rather than inserted one by one, and quotes that already exist in the guild are skipped.
+"""
+import csv
+import io
+import json
+import re
+import typing
+from hashlib import md5
+from itertools import islice
+
+import tortoise
+
+_NON_ALPHANUM = re.compile(r"\W")
+_BATCH_SIZE = 5000
+_EXPORT_QUERY = "SELECT user_id, added_by, content FROM quotes WHERE guild_id = $1 ORDER BY id"
+FORMATS = ('jsonl', 'csv')
+
+
+class QuoteFormatError(Exception):
+    """A quote to import is missing fields, or isn't in the expected format."""
+
+    pass
+
+
+def get_content_digest(content: str) -> str:
+    """A digest of the quote that ignores case and punctuation, to detect duplicate quotes."""
+    return md5(_NON_ALPHANUM.sub("", content.lower()).encode(), usedforsecurity=False).hexdigest()
+
+
+def read_quotes(file: typing.TextIO, format: str) -> typing.Iterator[dict]:
+    if format == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def import_quotes(guild_id: int, quotes: typing.Iterable[dict], default_added_by: int) -> tuple[int, int]:
+    """Imports quotes into a guild. Returns the number of quotes read, and how many of these were new."""
+    read = 0
+    quotes = iter(quotes)
+    async with tortoise.connections.get("default").acquire_connection() as connection:
+        async with connection.transaction():
+            await connection.execute("""
+CREATE TEMPORARY TABLE quote_imports (user_id BIGINT, added_by BIGINT, content TEXT, content_digest VARCHAR(32))
+ON COMMIT DROP;
+""")
+            while batch := list(islice(quotes, _BATCH_SIZE)):
+                records = [_to_record(read + i + 1, quote, default_added_by) for i, quote in enumerate(batch)]
+                await connection.copy_records_to_table('quote_imports', records=records)
+                read += len(records)
+            status = await connection.execute("""
+INSERT INTO quotes (guild_id, user_id, added_by, content, content_digest)
+SELECT $1, user_id, added_by, content, content_digest FROM quote_imports
+ON CONFLICT (guild_id, user_id, content_digest) DO NOTHING;
+""", guild_id)
+    return read, int(status.split()[-1])
+
+
+def _to_record(number: int, quote: dict, default_added_by: int) -> tuple[int, int, str, str]:
+    try:
+        content = quote['content']
+        if not isinstance(content, str) or not content:
+            raise ValueError('content must be a non-empty string')
+        added_by = int(quote.get('added_by') or default_added_by)
+        return int(quote['user_id']), added_by, content, get_content_digest(content)
+    except (KeyError, TypeError, ValueError) as e:
+        raise QuoteFormatError(f'Quote {number} is invalid: {e!r}') from e
+
+
+async def export_quotes(guild_id: int, format: str, output: typing.BinaryIO) -> int:
+    """Writes all quotes of a guild to a file. Returns the number of quotes written."""
+    async with tortoise.connections.get("default").acquire_connection() as connection:
+        if format == 'csv':
+            status = await connection.copy_from_query(_EXPORT_QUERY, guild_id, output=output, format='csv', header=True)
+            return int(status.split()[-1])
+        count = 0
+        text_output = io.TextIOWrapper(output, encoding='utf-8', write_through=True)
+        async with connection.transaction():  # cursors only exist in transactions
+            async for record in connection.cursor(_EXPORT_QUERY, guild_id, prefetch=_BATCH_SIZE):
+                text_output.write(json.dumps(dict(record)) + '\n')
+                count += 1
+        text_output.detach()  # leave the output open
+        return count
@@ -0,0 +1,73 @@
+"""
+Routing of read-only ORM queries to a read replica of the database, when one is configured. Writes, raw SQL and
+everything inside transactions stay on the primary, except read-only raw SQL that explicitly uses get_read_connection.
+
+Reads fall back to the primary while the replica lags behind by more than the configured limit, and for models that
+this process wrote to recently, so that it always reads its own writes (e.g. a config that was just set).
+"""
+import asyncio
+import logging
+import math
+import time
+
+import tortoise
+from tortoise import Model
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from snoozybot.config.env import envConfig
+
+logger = logging.getLogger(__name__)
+
+CONNECTION = 'replica'
+_LAG_CHECK_INTERVAL = 10  # seconds
+_replica_usable = False
+_primary: BaseDBAsyncClient | None = None
+_last_writes: dict[type[Model], float] = {}
+
+
+class ReplicaRouter:
+    def db_for_read(self, model: type[Model]) -> str | None:
+        if not _replica_usable:
+            return None
+        if tortoise.connections.get('default') is not _primary:
+            return None  # in a transaction, which only exists on the primary
+        # The replica lagged at most this long at the last check, so writes before that are visible on it
+        if time.monotonic() - _last_writes.get(model, -math.inf) < envConfig.db_replica_max_lag + _LAG_CHECK_INTERVAL:
+            return None
+        return CONNECTION
+
+    def db_for_write(self, model: type[Model]) -> None:
+        _last_writes[model] = time.monotonic()
+        return None  # the default connection
+
+
+def get_read_connection(model: type[Model]) -> BaseDBAsyncClient:
+    """The connection for raw SQL that only reads the given model's table, which the router doesn't handle."""
+    return tortoise.connections.get(ReplicaRouter().db_for_read(model) or 'default')
+
+
+async def monitor_lag() -> None:
+    """Keeps checking how far the replica is behind the primary, and stops reading from it while it lags too much."""
+    global _primary, _replica_usable
+    _primary = tortoise.connections.get('default')
+    replica = tortoise.connections.get(CONNECTION)
+    while True:
+        try:
+            _, rows = await replica.execute_query("""
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE extract(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END AS lag;
+""")
+            lag = float(rows[0]['lag'] or 0)
+        except Exception:
+            logger.exception('Failed to check the lag of the database replica')
+            lag = math.inf
+        usable = lag <= envConfig.db_replica_max_lag
+        if usable != _replica_usable:
+            if usable:
+                logger.info('Database replica is %.1fs behind, reading from it.', lag)
+            else:
+                logger.warning('Database replica is %.1fs behind, reading from the primary instead.', lag)
+            _replica_usable = usable
+        await asyncio.sleep(_LAG_CHECK_INTERVAL)
@@ -0,0 +1,54 @@
+import random
+import typing
+
+from cachetools import TTLCache
+from tortoise import Model
+
+_ModelT = typing.TypeVar('_ModelT', bound=Model)
+
+
+class RandomSampler(typing.Generic[_ModelT]):
+    """
+    Picks uniformly random rows of a model among the rows with the same values of some key fields (e.g. the quotes of a
+    user in a guild), without having the database sort all of them by random() on every pick.
+
+    The IDs of the rows of each key are cached, and a random one is fetched by its primary key. Invalidate the key
+    whenever rows are added to or deleted from it. Rows deleted elsewhere (e.g. by another process) are noticed when
+    they're picked, and the IDs are loaded again; rows added elsewhere are picked once the cached IDs expire.
+    """
+
+    def __init__(self, model: type[_ModelT], key_fields: typing.Sequence[str], maxsize: int = 1024,
+                 ttl: float = 600) -> None:
+        self._model = model
+        self._key_fields = tuple(key_fields)
+        self._ids: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)  # key values -> IDs of the rows
+
+    async def pick(self, *only: str, **key: typing.Any) -> _ModelT | None:
+        """A random row of the given key, or None if it has none. Pass field names to only load these fields."""
+        key_values = self._key_values(key)
+        ids = self._ids.get(key_values)
+        for _ in range(2):
+            if ids is None:
+                ids = await self._model.filter(**key).values_list('id', flat=True)
+                self._ids[key_values] = ids
+            if not ids:
+                return None
+            query = self._model.filter(id=random.choice(ids), **key)
+            if only:
+                query = query.only('id', *only)
+            if row := await query.first():
+                return row
+            ids = None  # picked a row that no longer exists, so the IDs are outdated
+        return None
+
+    def invalidate(self, **key: typing.Any) -> None:
+        """Forget the IDs of a key. Leaving out some of the key fields forgets all keys matching the rest."""
+        positions = [self._key_fields.index(field) for field in key]
+        for key_values in list(self._ids.keys()):
+            if all(key_values[i] == value for i, value in zip(positions, key.values())):
+                self._ids.pop(key_values, None)
+
+    def _key_values(self, key: dict[str, typing.Any]) -> tuple:
+        if key.keys() != set(self._key_fields):
+            raise ValueError(f'Expected values for exactly {self._key_fields}, got {tuple(key)}.')
+        return tuple(key[field] for field in self._key_fields)
@@ -5,7 +5,7 @@ import hikari
 from snoozybot.config import values
 from snoozybot.utils import LightbulbPlugin
 
-plugin = LightbulbPlugin('auto_unarchive')
+plugin = LightbulbPlugin('auto_unarchive', enabled_by=[values.auto_unarchive_channels])
 logger = logging.getLogger(__name__)
 
 
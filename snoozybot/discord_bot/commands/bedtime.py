@@ -14,7 +14,7 @@ from snoozybot.exceptions import UserError
 from snoozybot.utils import LightbulbPlugin
 
 logger = logging.getLogger(__name__)
-plugin = LightbulbPlugin('bedtime')
+plugin = LightbulbPlugin('bedtime', intents=hikari.Intents.GUILD_MESSAGES)
 
 _BEDTIME_CACHE: dict[int, User] = {}
 _BEDTIME_COOLDOWN = timedelta(minutes=20)
@@ -37,7 +37,7 @@ async def bedtime_set(ctx: lightbulb.SlashContext) -> None:
     """Set a bedtime. I will remind you to go to bed when you chat after this time."""
     # Convert user timezone to UTC
     time = ctx.options.time
-    async with tortoise.transactions.in_transaction() as tx:
+    async with tortoise.transactions.in_transaction('default') as tx:
         try:
             user = await User.select_for_update().using_db(tx).get(user_id=ctx.user.id)
             tz = pytz.timezone(user.timezone)
@@ -1,34 +1,186 @@
 import asyncio
+import importlib
+import json
 import logging
 import string
+import typing
 from collections import defaultdict
-from datetime import timedelta
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta
 
+import aiohttp
 import hikari
 import lightbulb
-from atproto import AsyncClient
+from async_lru import alru_cache
+from cachetools import TTLCache
 
 from snoozybot.config import values
+from snoozybot.config.env import envConfig
 from snoozybot.config.provider import get_secret_configs
+from snoozybot.database.poller_state import PollerStateStore
+from snoozybot.http_client import http_client
 from snoozybot.utils import LightbulbPlugin
 
-plugin = LightbulbPlugin('bluesky')
-client = AsyncClient()
-_LAST_KNOWN_POST_TIME: dict[str, str] = {}
+if typing.TYPE_CHECKING:
+    from atproto import AsyncClient, models
+
+plugin = LightbulbPlugin('bluesky', enabled_by=[values.bsky_post_notif_enabled])
+client: 'AsyncClient | None' = None  # atproto takes seconds to import, so it's only imported once enabled
+_LAST_KNOWN_POST_TIME = PollerStateStore('bluesky.post_time')
+_NOTIFY_USER_GUILDS: dict[lightbulb.BotApp, dict[str, set[int]]] = {}
+_USER_DIDS: dict[str, str] = {}
+_LAST_POLLED: dict[lightbulb.BotApp, datetime] = {}
+_JETSTREAM_POLL_INTERVAL = timedelta(hours=1)
 logger = logging.getLogger(__name__)
 
 
+class JetstreamConsumer:
+    """
+    Consumes new posts from a bluesky jetstream websocket, filtered to a set of DIDs. On disconnect, it reconnects and
+    resumes from the last event it has seen, so posts made in between are not lost.
+    """
+
+    _REWIND_US = 5_000_000  # resume slightly before the cursor; repeated posts are dropped
+
+    def __init__(self, url: str, on_post: Callable[[str, str, dict], Awaitable[None]]) -> None:
+        self._url = url
+        self._on_post = on_post
+        self._dids: frozenset[str] = frozenset()
+        self._cursor: int | None = None
+        self._options_changed = asyncio.Event()
+        self._seen_posts: TTLCache = TTLCache(maxsize=1024, ttl=600)
+
+    def set_dids(self, dids: set[str]) -> None:
+        """Changes the DIDs to follow. The websocket reconnects with the new filter if it changed."""
+        if dids != self._dids:
+            self._dids = frozenset(dids)
+            self._options_changed.set()
+
+    async def run(self) -> None:
+        backoff = 1
+        while True:
+            self._options_changed.clear()
+            if not self._dids:
+                await self._options_changed.wait()
+                continue
+            params = [('wantedCollections', 'app.bsky.feed.post')] + [('wantedDids', did) for did in self._dids]
+            if self._cursor:
+                params.append(('cursor', str(self._cursor - self._REWIND_US)))
+            try:
+                async with http_client.ws_connect(self._url, params=params, heartbeat=30) as ws:
+                    logger.info('Connected to bluesky jetstream for %d users, cursor %s', len(self._dids), self._cursor)
+                    backoff = 1
+                    reader = asyncio.create_task(self._read(ws))
+                    changed = asyncio.create_task(self._options_changed.wait())
+                    await asyncio.wait((reader, changed), return_when=asyncio.FIRST_COMPLETED)
+                    changed.cancel()
+                    if not reader.done():
+                        reader.cancel()  # reconnect with new options
+                        continue
+                    reader.result()
+                    logger.warning('Bluesky jetstream connection closed, reconnecting in %d seconds.', backoff)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Bluesky jetstream connection failed, reconnecting in %d seconds.', backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 300)
+
+    async def _read(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            event = json.loads(message.data)
+            self._cursor = event['time_us']
+            commit = event.get('commit')
+            if (
+                event.get('kind') != 'commit'
+                or commit['operation'] != 'create'
+                or commit['collection'] != 'app.bsky.feed.post'
+                or 'reply' in commit['record']
+                or (event['did'], commit['rkey']) in self._seen_posts
+            ):
+                continue
+            self._seen_posts[(event['did'], commit['rkey'])] = 0  # value doesnt matter
+            try:
+                await self._on_post(event['did'], commit['rkey'], commit['record'])
+            except Exception:
+                logger.exception('Failed to process bluesky post %s from %s', commit['rkey'], event['did'])
+
+
+jetstream: JetstreamConsumer | None = None
+
+
 @plugin.listener(hikari.StartedEvent)
 async def on_started(event: hikari.StartedEvent):
+    global client, jetstream
+    await _LAST_KNOWN_POST_TIME.load()
+    if client is None:
+        # Imported in a thread so that the gateway connections keep their heartbeats meanwhile
+        atproto = await asyncio.to_thread(importlib.import_module, 'atproto')
+        client = atproto.AsyncClient()
     _bsky_secret = await get_secret_configs('secret.bsky.credentials')
     _bsky_username, _bsky_password = next(iter(_bsky_secret.values())).get_secret_value().split()
     await client.login(_bsky_username, _bsky_password)
     logger.info('Started bluesky client.')
+    if jetstream is None and envConfig.bsky_jetstream_url:
+        jetstream = JetstreamConsumer(envConfig.bsky_jetstream_url, _on_jetstream_post)
+        event.app.create_task(jetstream.run())
+        logger.info('Started bluesky jetstream consumer.')
     await bsky_post_notif(event.app)  # it runs before login finishes
 
 
+def _get_client() -> 'AsyncClient':
+    if client is None:
+        raise RuntimeError('The bluesky client has not been started.')
+    return client
+
+
+@alru_cache(maxsize=64, ttl=3600)
+async def _get_profile(actor: str) -> 'models.AppBskyActorDefs.ProfileViewDetailed':
+    return await _get_client().get_profile(actor)
+
+
+async def _send_post_notif(guilds: set[int], app: lightbulb.BotApp, handle: str, display_name: str | None,
+                           post_id: str):
+    for guild in guilds:
+        channel_id = await values.bsky_post_notif_channel_id.get_value(guild)
+        channel = app.cache.get_guild_channel(channel_id)
+        if isinstance(channel, hikari.TextableChannel):
+            content_template = await values.bsky_post_notif_title_template.get_value(guild) or ''
+            post_url = f'https://bsky.app/profile/{handle}/post/{post_id}'
+            content = string.Template(content_template).safe_substitute({
+                'handle': handle, 'display': display_name, 'url': post_url,
+            })
+            await channel.send(content=content, user_mentions=True, role_mentions=True, mentions_everyone=True)
+            logger.info('Sent bsky notification to guild %s channel %s', guild, channel_id)
+        else:
+            logger.error('Did not send a bsky notification for guild %s channel %s: invalid channel ID',
+                         guild, channel)
+
+
+async def _on_jetstream_post(did: str, post_id: str, record: dict) -> None:
+    post_time = record['createdAt']
+    # Skip posts that were already announced, by the fallback poll or before the jetstream resumed from its cursor
+    users = [user for user, user_did in _USER_DIDS.items()
+             if user_did == did and (user not in _LAST_KNOWN_POST_TIME or _LAST_KNOWN_POST_TIME[user] < post_time)]
+    if not users:
+        logger.info('Skipped bsky post %s from jetstream, it was already announced.', post_id)
+        return
+    logger.info('Received bsky post %s from jetstream, sending notifications...', post_id)
+    profile = await _get_profile(did)
+    await asyncio.gather(*(
+        _send_post_notif(set().union(*(user_guilds.get(user, set()) for user in users)), app,
+                         profile.handle, profile.display_name, post_id)
+        for app, user_guilds in _NOTIFY_USER_GUILDS.items()
+    ))
+    for user in users:
+        if _LAST_KNOWN_POST_TIME.get(user, '') < post_time:
+            _LAST_KNOWN_POST_TIME[user] = post_time
+
+
 async def _check_and_notify_bsky_posts(user: str, guilds: set[int], app: lightbulb.BotApp):
-    resp = await client.get_author_feed(user, filter="posts_no_replies", limit=1)
+    resp = await _get_client().get_author_feed(user, filter="posts_no_replies", limit=1)
     post = resp.feed[0]
     # This is the latest non-reply post
     post_time = post.post.record.created_at
@@ -41,34 +193,31 @@ async def _check_and_notify_bsky_posts(user: str, guilds: set[int], app: lightbu
         # This is a new post
         logger.info('Found new bsky post: %s, sending notifications...', post_id)
         _LAST_KNOWN_POST_TIME[user] = post_time
-        for guild in guilds:
-            channel_id = await values.bsky_post_notif_channel_id.get_value(guild)
-            channel = app.cache.get_guild_channel(channel_id)
-            if isinstance(channel, hikari.TextableChannel):
-                content_template = await values.bsky_post_notif_title_template.get_value(guild) or ''
-                post_url = f'https://bsky.app/profile/{post.post.author.handle}/post/{post_id}'
-                content = string.Template(content_template).safe_substitute({
-                    'handle': post.post.author.handle, 'display': post.post.author.display_name, 'url': post_url,
-                })
-                await channel.send(content=content, user_mentions=True, role_mentions=True, mentions_everyone=True)
-                logger.info('Sent bsky notification to guild %s channel %s', guild, channel_id)
-            else:
-                logger.error('Did not send a bsky notification for guild %s channel %s: invalid channel ID',
-                             guild, channel)
+        await _send_post_notif(guilds, app, post.post.author.handle, post.post.author.display_name, post_id)
 
 
 @plugin.periodic_task(timedelta(minutes=10))
 async def bsky_post_notif(app: lightbulb.BotApp):
     # Get the channels to check for each guild
-    if client.me:
+    if client is not None and client.me:
         user_guilds = defaultdict(set)
         for guild in app.default_enabled_guilds:
             if await values.bsky_post_notif_enabled.get_value(guild):
                 users = await values.bsky_post_notif_users.get_value(guild) or []
                 for user in users:
                     user_guilds[user].add(guild)
+        _NOTIFY_USER_GUILDS[app] = user_guilds
 
         try:
+            if jetstream is not None:
+                # Jetstream sends every post as it happens. Polling is only a fallback for missed posts.
+                all_users = set().union(*_NOTIFY_USER_GUILDS.values())
+                for user in all_users - _USER_DIDS.keys():
+                    _USER_DIDS[user] = (await _get_profile(user)).did
+                jetstream.set_dids({_USER_DIDS[user] for user in all_users})
+                if datetime.now() - _LAST_POLLED.get(app, datetime.min) < _JETSTREAM_POLL_INTERVAL:
+                    return
+            _LAST_POLLED[app] = datetime.now()
             # Check which accounts had a new post
             await asyncio.gather(*(
                 _check_and_notify_bsky_posts(did, guilds, app=app) for did, guilds in user_guilds.items()
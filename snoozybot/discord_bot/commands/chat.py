@@ -1,3 +1,4 @@
+import functools
 import logging
 import random
 import re
@@ -5,25 +6,29 @@ from collections import defaultdict, deque
 from dataclasses import dataclass
 from datetime import datetime
 
-import google.api_core.exceptions
-import google.generativeai as gemini
 import hikari
 import lightbulb
-import openai
 from async_lru import alru_cache
 
-from snoozybot.chat import get_openai
+from snoozybot.chat import get_gemini, get_openai, get_server_errors
 from snoozybot.config import values
 from snoozybot.config.provider import cached_config
 from snoozybot.utils import CooldownManager, LightbulbPlugin
 
 logger = logging.getLogger(__name__)
-plugin = LightbulbPlugin('chat')
+plugin = LightbulbPlugin('chat', intents=hikari.Intents.GUILD_MESSAGES | hikari.Intents.MESSAGE_CONTENT,
+                         enabled_by=[values.chat_rb_enabled, values.chat_ai_enabled])
 _non_alphanum = re.compile(r'[^a-zA-Z0-9_]')
 _HISTORY_SIZE = 6
 _ai_message_buffer: dict[int, deque[hikari.Message]] = defaultdict(lambda: deque(maxlen=6))
 
 
+@functools.cache
+def _get_fallback_errors() -> tuple[type[Exception], ...]:
+    """Errors on which AI replies fall back to text replies. Built on first use, like the AI clients themselves."""
+    return ValueError, *get_server_errors()
+
+
 @dataclass
 class ChatHistoryItem:
     content: str
@@ -47,7 +52,7 @@ async def on_guild_message_create(event: hikari.GuildMessageCreateEvent) -> None
                 # Member has AI enabled role. Respond with AI.
                 try:
                     await _chat_guild_respond_ai(event)
-                except (openai.InternalServerError, google.api_core.exceptions.InternalServerError, ValueError):
+                except _get_fallback_errors():
                     await _chat_guild_respond_text(event)
             # Always add message to AI message buffer in case it's needed later
             if event.message.content:
@@ -177,6 +182,7 @@ async def _chat_respond_gemini(message: hikari.Message, prompts: list[str], hist
         f"{message.member.display_name} said: {message.content}",
     ])
     prompt = [{"role": "user", "parts": chat_history}]
+    gemini = get_gemini()
     model = gemini.GenerativeModel("gemini-1.5-flash", system_instruction=system_prompt)
     response = await model.generate_content_async(
         prompt,
@@ -9,7 +9,11 @@ from snoozybot.config import values
 from snoozybot.config.provider import cached_config
 from snoozybot.utils import LightbulbPlugin
 
-plugin = LightbulbPlugin('logs')
+plugin = LightbulbPlugin(
+    'logs',
+    intents=hikari.Intents.GUILD_MESSAGES | hikari.Intents.MESSAGE_CONTENT | hikari.Intents.GUILD_MODERATION,
+    enabled_by=[values.logs_enabled],
+)
 
 _AUDIT_DELAY = 3.0
 DeleteAuditKey = namedtuple('DeleteAuditKey', ('guild', 'channel', 'author'))
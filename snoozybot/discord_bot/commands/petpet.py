@@ -3,10 +3,9 @@ from io import BytesIO
 
 import hikari
 import lightbulb
-import petpetgif
-import petpetgif.petpet
 
 from snoozybot.exceptions import UserError
+from snoozybot.http_client import http_client
 from snoozybot.utils import LightbulbPlugin
 
 logger = logging.getLogger(__name__)
@@ -22,7 +21,10 @@ async def petpet(ctx: lightbulb.SlashContext):
     url: hikari.URL = ctx.options.user.display_avatar_url
     if not url:
         raise UserError(f'{ctx.options.user} does not seem to have a profile picture.')
-    image_data = BytesIO(await url.read())
+    async with http_client.get(str(url)) as resp:
+        resp.raise_for_status()
+        image_data = BytesIO(await resp.read())
+    import petpetgif.petpet  # imports Pillow, which is only needed here
     output = BytesIO()
     petpetgif.petpet.make(image_data, output)
     output.seek(0)  # so it uploads
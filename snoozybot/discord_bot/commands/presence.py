@@ -1,81 +1,200 @@
+import asyncio
 import logging
 import string
+import typing
+from datetime import timedelta
 
 import hikari
+import lightbulb
+import twitchio
 from cachetools import TTLCache
 
 from snoozybot.config import values
 from snoozybot.utils import LightbulbPlugin
 
-plugin = LightbulbPlugin('presence')
+plugin = LightbulbPlugin('presence', intents=hikari.Intents.GUILD_PRESENCES,
+                         enabled_by=[values.presence_streaming_role])
 logger = logging.getLogger(__name__)
 _recent_notifs: TTLCache = TTLCache(maxsize=256, ttl=600)
+_RECONCILE_CONCURRENCY = 4
+_STREAMING_ROLES: dict[int, int] = {}  # guild id -> streaming role id, only for guilds that have one
+_preview_tasks: set[asyncio.Task] = set()  # referenced until done, so they aren't garbage collected while running
 
 
 @plugin.listener(hikari.GuildAvailableEvent)
 async def on_guild_available(event: hikari.GuildAvailableEvent):
-    # We don't know if someone's status need changing after a disconnect to recompute everyone
-    for presence in event.presences.values():
-        if presence.activities is not None:
-            await _process_presence(presence, event.members[presence.user_id])
+    # We don't know if someone's status need changing after a disconnect, so compare everyone against the role holders
+    streaming_role = await values.presence_streaming_role.get_value(event.guild_id)
+    _set_streaming_role(event.guild_id, streaming_role)
+    if streaming_role:
+        await _reconcile_streaming_role(event.guild_id, streaming_role, event.members, event.presences.get)
 
 
-@plugin.listener(hikari.PresenceUpdateEvent)
-async def on_presence_update(event: hikari.PresenceUpdateEvent):
-    await _process_presence(event.presence, None)
+@plugin.listener(hikari.MemberChunkEvent)
+async def on_member_chunk(event: hikari.MemberChunkEvent):
+    # Large guilds only come with their online members; the offline ones arrive in chunks later, without presences.
+    # Those were all sent with the guild, so anyone not in the cache is offline.
+    streaming_role = _STREAMING_ROLES.get(event.guild_id)
+    if streaming_role:
+        await _reconcile_streaming_role(event.guild_id, streaming_role, event.members,
+                                        lambda user_id: event.app.cache.get_presence(event.guild_id, user_id))
+
+
+async def _reconcile_streaming_role(
+    guild_id: int,
+    streaming_role: int,
+    members: typing.Mapping[hikari.Snowflake, hikari.Member],
+    get_presence: typing.Callable[[hikari.Snowflake], hikari.MemberPresence | None],
+) -> None:
+    """Gives the streaming role to the members that are streaming, and takes it from everyone else (e.g. offline)."""
+    to_add: list[tuple[hikari.Member, list[hikari.RichActivity]]] = []
+    to_remove: list[hikari.Member] = []
+    for user_id, member in members.items():
+        presence = get_presence(user_id)
+        if presence is not None and presence.activities is None:
+            continue
+        streams = _get_streams(presence) if presence is not None else []
+        if streams and streaming_role not in member.role_ids:
+            to_add.append((member, streams))
+        elif not streams and streaming_role in member.role_ids:
+            to_remove.append(member)
+    if not to_add and not to_remove:
+        return
+    logger.info('Updating streaming role in guild %s: adding %d members, removing %d members',
+                guild_id, len(to_add), len(to_remove))
+    # Role changes are rate limited per guild anyway; don't queue up thousands of requests at once
+    semaphore = asyncio.Semaphore(_RECONCILE_CONCURRENCY)
+
+    async def apply(func: typing.Callable[..., typing.Awaitable], *args) -> None:
+        async with semaphore:
+            try:
+                await func(*args)
+            except hikari.HTTPError:
+                logger.exception('Failed to update streaming role for user %s in guild %s', args[0], guild_id)
+
+    await asyncio.gather(
+        *(apply(_add_streaming_role, member, streams, streaming_role) for member, streams in to_add),
+        *(apply(_remove_streaming_role, member, streaming_role) for member in to_remove),
+    )
 
 
-async def _process_presence(presence: hikari.MemberPresence, member: hikari.Member | None):
-    streaming_role = await values.presence_streaming_role.get_value(presence.guild_id)
-    if not streaming_role:
+@plugin.listener(hikari.PresenceUpdateEvent)
+async def on_presence_update(event: hikari.PresenceUpdateEvent):
+    # This is by far the busiest event. Drop everything that can't change the streaming role without awaiting anything.
+    streaming_role = _STREAMING_ROLES.get(event.guild_id)
+    presence = event.presence
+    if not streaming_role or presence.activities is None:
         return
+    streams = _get_streams(presence)
+    if event.old_presence is not None and bool(streams) == bool(_get_streams(event.old_presence)):
+        return  # Not starting or stopping a stream
+    member = event.app.cache.get_member(event.guild_id, event.user_id)
+    if member is not None and bool(streams) == (streaming_role in member.role_ids):
+        return  # Role is already correct
     logger.debug(f'Received presence update for user {presence.user_id} in guild {presence.guild_id}: {presence}')
-    streams = [activity for activity in presence.activities
-               if activity.type == hikari.ActivityType.STREAMING and activity.url]
     member = member or await presence.fetch_member()
-    cache_key = (presence.guild_id, member.id)
     if streams and streaming_role not in member.role_ids:
-        # add role
-        await member.add_role(streaming_role)
-        logger.info(f'Set streaming role for user {member} in guild {member.guild_id}.')
-        # send message
-        channel_id = await values.presence_streaming_notif_channel_id.get_value(presence.guild_id)
-        if channel_id and cache_key not in _recent_notifs:
-            template = await values.presence_streaming_notif_title_template.get_value(presence.guild_id) or ''
-            text = string.Template(template).safe_substitute({'mention': member.mention, 'user': member.display_name})
-            text_content, embeds = await _get_presence_message(streams)
-            channel: hikari.TextableGuildChannel = member.get_guild().get_channel(channel_id)
-            await channel.send(content=text + '\n' + text_content, embeds=embeds)
-            logger.info(f'Sent going live message for user {member} to guild {member.guild_id}, channel {channel_id}.')
-    elif presence.activities is not None and streaming_role in member.role_ids:
-        # remove role
-        await member.remove_role(streaming_role)
-        logger.info(f'Removed streaming role for user {member} in guild {member.guild_id}')
+        await _add_streaming_role(member, streams, streaming_role)
+    elif not streams and streaming_role in member.role_ids:
+        await _remove_streaming_role(member, streaming_role)
+
+
+@plugin.listener(hikari.StartingEvent)
+async def on_starting(event: hikari.StartingEvent):
+    await _refresh_streaming_roles(event.app)
+
+
+@plugin.periodic_task(timedelta(minutes=10))
+async def refresh_streaming_roles(app: lightbulb.BotApp):
+    try:
+        await _refresh_streaming_roles(app)
+    except Exception:
+        # Consume the exception so that the periodic task continues.
+        logger.exception('Failed to refresh streaming roles.')
+
+
+async def _refresh_streaming_roles(app: lightbulb.BotApp):
+    """Keep track of which guilds have a streaming role, so presence updates can be filtered without a config read."""
+    for guild in app.default_enabled_guilds:
+        _set_streaming_role(guild, await values.presence_streaming_role.get_value(guild))
+
+
+def _set_streaming_role(guild_id: int, streaming_role: int | None):
+    if streaming_role:
+        _STREAMING_ROLES[guild_id] = streaming_role
+    else:
+        _STREAMING_ROLES.pop(guild_id, None)
+
+
+def _get_streams(presence: hikari.MemberPresence) -> list[hikari.RichActivity]:
+    return [activity for activity in presence.activities
+            if activity.type == hikari.ActivityType.STREAMING and activity.url]
+
+
+async def _add_streaming_role(member: hikari.Member, streams: list[hikari.RichActivity], streaming_role: int):
+    cache_key = (member.guild_id, member.id)
+    await member.add_role(streaming_role)
+    logger.info(f'Set streaming role for user {member} in guild {member.guild_id}.')
+    # send message
+    channel_id = await values.presence_streaming_notif_channel_id.get_value(member.guild_id)
+    if channel_id and cache_key not in _recent_notifs:
+        template = await values.presence_streaming_notif_title_template.get_value(member.guild_id) or ''
+        text = string.Template(template).safe_substitute({'mention': member.mention, 'user': member.display_name})
+        text_content, embeds, twitch_streams = await _get_presence_message(streams)
+        channel: hikari.TextableGuildChannel = member.get_guild().get_channel(channel_id)
+        message = await channel.send(content=text + '\n' + text_content, embeds=embeds)
+        if twitch_streams:
+            from snoozybot.discord_bot.commands.twitch import (
+                _attach_stream_previews,
+            )
+            task = asyncio.create_task(_attach_stream_previews(message, twitch_streams))
+            _preview_tasks.add(task)
+            task.add_done_callback(_preview_tasks.discard)
+        logger.info(f'Sent going live message for user {member} to guild {member.guild_id}, channel {channel_id}.')
     _recent_notifs[cache_key] = 0  # value doesnt matter
 
 
-async def _get_presence_message(streams: list[hikari.RichActivity]) -> tuple[str, list[hikari.Embed]]:
+async def _remove_streaming_role(member: hikari.Member, streaming_role: int):
+    await member.remove_role(streaming_role)
+    logger.info(f'Removed streaming role for user {member} in guild {member.guild_id}')
+    _recent_notifs[(member.guild_id, member.id)] = 0  # value doesnt matter
+
+
+async def _get_presence_message(
+    streams: list[hikari.RichActivity],
+) -> tuple[str, list[hikari.Embed], list[twitchio.Stream]]:
     text = ''
     embeds: list[hikari.Embed] = []
+    twitch_streams_found: list[twitchio.Stream] = []
     for stream in streams:
         if stream.url and stream.url.startswith('https://www.twitch.tv/'):
             # import here cuz this might not be ready at module load time
             from snoozybot.discord_bot.commands.twitch import (
                 _generate_stream_embed,
+                stream_status,
                 twitch,
+                twitch_metadata,
             )
 
+            if twitch is None:
+                # No bot has twitch notifications enabled, so the twitch client was never started
+                text += stream.url + '\n'
+                continue
             # Twitch default embeds are poop. Generate it myself
             twitch_username = stream.url[22:]
-            twitch_streams = await twitch.fetch_streams(user_logins=[twitch_username])
-            twitch_users = await twitch.fetch_users(names=[twitch_username])
+            twitch_streams, twitch_users = await asyncio.gather(
+                stream_status.get_streams([twitch_username]),
+                twitch_metadata.get_users_by_login([twitch_username]),
+            )
             if twitch_streams and twitch_users:
-                embeds.append(await _generate_stream_embed(twitch_streams[0], -1, twitch_users[0]))
+                twitch_stream = next(iter(twitch_streams.values()))
+                embeds.append(await _generate_stream_embed(twitch_stream, -1, *twitch_users.values()))
+                twitch_streams_found.append(twitch_stream)
             else:
                 logger.warning(f'No stream at {stream.url}. Sending text instead.')
                 text += stream.url + '\n'
         elif stream.url:
             text += stream.url + '\n'
-    return text, embeds
+    return text, embeds, twitch_streams_found
 
 load, unload = plugin.export_extension()
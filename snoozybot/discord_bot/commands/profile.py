@@ -10,8 +10,13 @@ import pytz
 import tortoise.transactions
 
 from snoozybot.config import values
-from snoozybot.database.fields import Random
-from snoozybot.database.models import GuildMember, User
+from snoozybot.database.birthdays import (
+    UpcomingBirthday,
+    birthdays,
+    get_next_birthday_utc,
+)
+from snoozybot.database.models import GuildMember
+from snoozybot.database.sampling import RandomSampler
 from snoozybot.exceptions import UserError
 from snoozybot.utils import LightbulbPlugin
 
@@ -22,6 +27,9 @@ _FRIEND_CODE_SERVICES = ['Steam', 'Nintendo Switch', 'Pokemon Go', 'Playstation
                          'Genshin Impact']
 _DISCORD_IMAGE_URL = re.compile(
     r'https://(?:cdn|media)\.discordapp\.(?:com|net)/attachments/\d+/\d+/.*\.(?:jpg|png|webp|gif)', re.IGNORECASE)
+# Also check the database this often, for birthdays moved earlier by other processes and for pending greetings
+_BIRTHDAY_RESYNC = timedelta(minutes=15)
+_random_profiles = RandomSampler(GuildMember, ('guild_id',))
 
 
 @plugin.command
@@ -58,10 +66,13 @@ async def profile_add_birthday(ctx: lightbulb.SlashContext) -> None:
         datetime(year=2000, month=month, day=day)
     except ValueError:
         raise UserError(f'{month}/{day} is not a valid date.')
-    next_birthday = await _get_next_birthday_utc(ctx.user.id, month, day)
-    await GuildMember.update_or_create({
+    next_birthday = await get_next_birthday_utc(ctx.user.id, month, day)
+    member, created = await GuildMember.update_or_create({
         "birthday_month": month, "birthday_day": day, "next_birthday_utc": next_birthday,
     }, guild_id=ctx.guild_id, user_id=ctx.user.id)
+    if created:
+        _random_profiles.invalidate(guild_id=ctx.guild_id)
+    birthdays.set(member)
     await ctx.respond("I have saved your birthday.")
 
 
@@ -70,7 +81,7 @@ async def profile_add_birthday(ctx: lightbulb.SlashContext) -> None:
 @lightbulb.implements(lightbulb.SlashSubCommand)
 async def profile_remove_birthday(ctx: lightbulb.SlashContext) -> None:
     """Remove your birthday."""
-    async with tortoise.transactions.in_transaction() as tx:
+    async with tortoise.transactions.in_transaction('default') as tx:
         member = await GuildMember.select_for_update().using_db(tx).get_or_none(
             guild_id=ctx.guild_id, user_id=ctx.user.id)
         if member:
@@ -78,6 +89,7 @@ async def profile_remove_birthday(ctx: lightbulb.SlashContext) -> None:
             member.birthday_day = None
             member.next_birthday_utc = None
             await member.save(using_db=tx)
+        birthdays.remove(ctx.guild_id, ctx.user.id)
         await ctx.respond("I have removed your birthday.")
 
 
@@ -87,10 +99,7 @@ async def profile_remove_birthday(ctx: lightbulb.SlashContext) -> None:
 async def next_birthdays(ctx: lightbulb.SlashContext) -> None:
     today = datetime.now(pytz.utc).replace(hour=0, minute=0, second=0)
     # Get profiles with birthday after today
-    members = await GuildMember.filter(
-        guild_id=ctx.guild_id,
-        next_birthday_utc__gte=today,
-    ).order_by('next_birthday_utc').limit(10)
+    members = birthdays.upcoming(ctx.guild_id, today, 10)
     if not members:
         raise UserError('No one on this server has a birthday set.')
     else:
@@ -159,17 +168,19 @@ async def profile_remove_refsheet(ctx: lightbulb.SlashContext) -> None:
 async def _set_profile_field(guild: hikari.Guild, user: hikari.User, field: Sequence[str], value: Any):
     """Sets a field for a user."""
     # Update the relevant field
-    async with tortoise.transactions.in_transaction() as tx:
-        prof, _ = await GuildMember.get_or_create(guild_id=guild.id, user_id=user.id, defaults={'data': {}},
-                                                  using_db=tx)
+    async with tortoise.transactions.in_transaction('default') as tx:
+        prof, created = await GuildMember.get_or_create(guild_id=guild.id, user_id=user.id, defaults={'data': {}},
+                                                        using_db=tx)
         _recursive_set_dict(prof.profile_data, field, value)
         await prof.save(using_db=tx)
+    if created:
+        _random_profiles.invalidate(guild_id=guild.id)
 
 
 async def _unset_profile_field(guild: hikari.Guild, user: hikari.User, field: Sequence[str]):
     """Removes a field for a user."""
     try:
-        async with tortoise.transactions.in_transaction() as tx:
+        async with tortoise.transactions.in_transaction('default') as tx:
             prof = await GuildMember.select_for_update().using_db(tx).get(guild_id=guild.id, user_id=user.id)
             _recursive_del_dict(prof.data, field)
             if prof.data:
@@ -177,6 +188,7 @@ async def _unset_profile_field(guild: hikari.Guild, user: hikari.User, field: Se
             else:
                 # Delete the profile entirely if there's no data left
                 await prof.delete(using_db=tx)
+                _random_profiles.invalidate(guild_id=guild.id)
     except (KeyError, tortoise.exceptions.DoesNotExist):
         raise UserError('You do not have that particular profile item. Your profile was not changed.')
 
@@ -201,8 +213,7 @@ async def profile_get(ctx: lightbulb.SlashContext) -> None:
 @lightbulb.command("random", description="Privately view a random profile card from this server.", ephemeral=True)
 @lightbulb.implements(lightbulb.SlashSubCommand)
 async def profile_random(ctx: lightbulb.SlashContext) -> None:
-    prof = await GuildMember.filter(guild_id=ctx.guild_id).annotate(
-        random=Random("id")).order_by("random").limit(1).first()
+    prof = await _random_profiles.pick(guild_id=ctx.guild_id)
     if prof:
         embed = _generate_profile_embed(ctx.get_guild(), prof)
         await ctx.respond(embed=embed)
@@ -229,6 +240,8 @@ async def profile_post(ctx: lightbulb.SlashContext) -> None:
 async def on_member_leave(event: hikari.MemberDeleteEvent) -> None:
     """Remove info about the member if they leave."""
     await GuildMember.filter(guild_id=event.guild_id, user_id=event.user_id).delete()
+    _random_profiles.invalidate(guild_id=event.guild_id)
+    birthdays.remove(event.guild_id, event.user_id)
 
 
 def _generate_profile_embed(guild: hikari.Guild, prof: GuildMember) -> hikari.Embed | None:
@@ -251,51 +264,65 @@ def _generate_profile_embed(guild: hikari.Guild, prof: GuildMember) -> hikari.Em
 
 
 # BIRTHDAYS
-async def _get_next_birthday_utc(user_id: int, month: int, day: int) -> datetime:
-    # Get current date in user's timezone
-    user = await User.get_or_none(user_id=user_id)
-    if not user or not user.timezone:
-        raise UserError("You have not set a timezone for yourself. Please set a timezone with /timezone "
-                        "first so I can properly understand your birthday.")
-    tz = pytz.timezone(user.timezone)
-    today = datetime.now(tz)
-    # Determine if next birthday is in current year or next year
-    if today.month > month or (today.month == month and today.day >= day):
-        next_birthday_year = today.year + 1
-    else:
-        next_birthday_year = today.year
-    birthday_local = tz.normalize(tz.localize(datetime(next_birthday_year, month, day)))
-    # Convert back to utc
-    birthday_utc = birthday_local.astimezone(pytz.utc)
-    return birthday_utc
-
-
 # Automatic Birthday Notification
-@plugin.periodic_task(timedelta(minutes=15))
-async def birthday_reminder(app: lightbulb.BotApp):
-    async with tortoise.transactions.in_transaction() as tx:
-        members = GuildMember.select_for_update().using_db(tx).filter(
-            guild_id__in=app.default_enabled_guilds,
-            next_birthday_utc__lte=datetime.now(pytz.utc),
-        )
-        async for member in members:
-            channel_id = await values.profile_birthday_channel.get_value(member.guild_id)
-            if not channel_id:
-                continue
-            user = app.cache.get_member(member.guild_id, member.user_id)
-            channel = app.cache.get_guild_channel(channel_id)
-            if not user or not channel:
-                continue
+@plugin.listener(hikari.StartingEvent)
+async def on_starting(event: hikari.StartingEvent) -> None:
+    await birthdays.load(event.app.default_enabled_guilds)
+
+
+@plugin.listener(hikari.StartedEvent)
+async def on_started(event: hikari.StartedEvent) -> None:
+    event.app.create_task(birthday_scheduler(event.app))
+
+
+async def birthday_scheduler(app: lightbulb.BotApp):
+    """Sleeps until the next birthday in this bot's guilds and sends greetings right at the user's local midnight."""
+    while True:
+        now = datetime.now(pytz.utc)
+        try:
+            due = await birthdays.refresh_due(app.default_enabled_guilds, now)
+        except Exception:
+            logger.exception('Birthday: Failed to read due birthdays.')
+            due = []
+        for birthday in due:
             try:
-                member.next_birthday_utc = await _get_next_birthday_utc(
-                    member.user_id, member.birthday_month, member.birthday_day)
-                await channel.send(f"🎂 **Happy birthday, {user.mention}!** 🎂", user_mentions=True)
-            except UserError:
-                logger.warning(f'Birthday: did not send birthday note for {member} '
-                               'because they do not have a timezone.')
-            except hikari.ClientHTTPResponseError:
-                logger.exception(f'Birthday: Failed to send birthday message for {member}.')
-            await member.save(using_db=tx)
+                # Birthdays that can't be sent yet (e.g. member not in cache) stay due, and are tried again later
+                await _send_birthday_greeting(app, birthday)
+            except Exception:
+                # Consume the exception so that the scheduler continues.
+                logger.exception(f'Birthday: Failed to process birthday {birthday}.')
+        next_due = birthdays.next_due(app.default_enabled_guilds, now)
+        timeout = _BIRTHDAY_RESYNC.total_seconds()
+        if next_due:
+            timeout = min(timeout, (next_due - now).total_seconds())
+        await birthdays.wait_for_change(timeout)
+
+
+async def _send_birthday_greeting(app: lightbulb.BotApp, birthday: UpcomingBirthday) -> bool:
+    """Sends a birthday greeting, returning whether the birthday was handled and moved to the next year."""
+    channel_id = await values.profile_birthday_channel.get_value(birthday.guild_id)
+    if not channel_id:
+        return False
+    user = app.cache.get_member(birthday.guild_id, birthday.user_id)
+    channel = app.cache.get_guild_channel(channel_id)
+    if not user or not channel:
+        return False
+    try:
+        next_birthday = await get_next_birthday_utc(birthday.user_id, birthday.birthday_month, birthday.birthday_day)
+    except UserError:
+        logger.warning(f'Birthday: did not send birthday note for {birthday} because they do not have a timezone.')
+        return False
+    # Only the bot that moves the birthday forward sends the greeting, in case several bots share the guild.
+    updated = await GuildMember.filter(
+        guild_id=birthday.guild_id, user_id=birthday.user_id, next_birthday_utc=birthday.next_birthday_utc,
+    ).update(next_birthday_utc=next_birthday)
+    if updated:
+        birthdays.set(birthday._replace(next_birthday_utc=next_birthday))
+        try:
+            await channel.send(f"🎂 **Happy birthday, {user.mention}!** 🎂", user_mentions=True)
+        except hikari.ClientHTTPResponseError:
+            logger.exception(f'Birthday: Failed to send birthday message for {birthday}.')
+    return True
 
 
 def _recursive_set_dict(d: dict, keys: Sequence[str], value: Any):
@@ -1,17 +1,46 @@
-import re
-from hashlib import md5
+import io
+from dataclasses import dataclass, field
 
 import hikari
 import lightbulb
 import tortoise
+from cachetools import TTLCache
 
-from snoozybot.database.fields import Random
+from snoozybot.database import quote_transfer
 from snoozybot.database.models import Quote
+from snoozybot.database.sampling import RandomSampler
 from snoozybot.exceptions import UserError
 from snoozybot.utils import CooldownManager, LightbulbPlugin
 
 plugin = LightbulbPlugin('quote')
-_NON_ALPHANUM = re.compile(r"\W")
+_SEARCH_PAGE_PREFIX = 'quotes:find:'
+_SEARCH_PAGE_SIZE = 10
+# Uses the full text search index on quotes. Results are ordered by rank, and pages continue after the (rank, id) of
+# the last quote of the previous page.
+_SEARCH_QUERY = """
+SELECT id, user_id, content, rank
+FROM (
+    SELECT id, user_id, content, ts_rank(to_tsvector('english', content), query) AS rank
+    FROM quotes, websearch_to_tsquery('english', $3) AS query
+    WHERE guild_id = $1 AND ($2::bigint IS NULL OR user_id = $2) AND to_tsvector('english', content) @@ query
+) AS matches
+WHERE $4::real IS NULL OR (rank, id) < ($4::real, $5::int)
+ORDER BY rank DESC, id DESC
+LIMIT $6
+"""
+_random_quotes = RandomSampler(Quote, ('guild_id', 'user_id'))
+
+
+@dataclass
+class _QuoteSearch:
+    """A quote search being browsed through. The pages seen so far are kept, to be able to go back to them."""
+    guild_id: int
+    user_id: int | None
+    text: str | None
+    page_starts: list[tuple[float, int] | None] = field(default_factory=lambda: [None])
+
+
+_searches: TTLCache = TTLCache(maxsize=256, ttl=3600)  # _QuoteSearch by the interaction that started them
 
 
 @plugin.command
@@ -45,10 +74,11 @@ async def _add_quote(ctx: lightbulb.ApplicationContext, quoted_user: hikari.User
     if quoted_user == ctx.bot.get_me():
         raise UserError("Don't quote me on that.")
     # Compute a digest of the quote message to prevent duplicates.
-    digest = md5(_NON_ALPHANUM.sub("", content.lower()).encode(), usedforsecurity=False).hexdigest()
+    digest = quote_transfer.get_content_digest(content)
     try:
         quote = await Quote.create(guild_id=ctx.guild_id, user_id=quoted_user.id, added_by=ctx.author.id,
                                    content=content, content_digest=digest)
+        _random_quotes.invalidate(guild_id=ctx.guild_id, user_id=quoted_user.id)
         return quote.id
     except tortoise.exceptions.IntegrityError as e:
         raise UserError("This quote already exists.") from e
@@ -56,31 +86,44 @@ async def _add_quote(ctx: lightbulb.ApplicationContext, quoted_user: hikari.User
 
 @quotes_group.child
 @lightbulb.option("user", description="Find quotes by a particular user", type=hikari.Member, default=None)
-@lightbulb.option("search", description="Find quotes including this phrase", default=None)
+@lightbulb.option("search", description="Find quotes including these words", default=None)
 @lightbulb.command("find", description="Find existing quotes.", ephemeral=True)
 @lightbulb.implements(lightbulb.SlashSubCommand)
 async def quotes_find(ctx: lightbulb.SlashContext) -> None:
     """Find existing quotes."""
-    query = Quote.filter(guild_id=ctx.guild_id).limit(11)
-    if ctx.options.user:
-        query = query.filter(user_id=ctx.options.user.id)
-    if ctx.options.search:
-        query = query.filter(content__icontains=ctx.options.search.strip())
-
-    results = await query
-    if results:
-        embed = hikari.Embed()
-        for quote in results[:10]:
-            embed.add_field(name=f"[{quote.id}] {ctx.get_guild().get_member(quote.user_id).display_name}",
-                            value=quote.content, inline=False)
-        if len(results) > 10:
-            embed.description = "Only the first 10 quotes are displayed, but more are available. " \
-                                "Enter a more specific search query to find more quotes."
-        await ctx.respond(embed=embed)
+    search = _QuoteSearch(
+        guild_id=ctx.guild_id,
+        user_id=ctx.options.user.id if ctx.options.user else None,
+        text=ctx.options.search.strip() if ctx.options.search else None,
+    )
+    _searches[ctx.interaction.id] = search
+    embed, component = await _get_search_page(ctx.app, ctx.interaction.id, search, 0)
+    if embed:
+        await ctx.respond(embed=embed, component=component)
     else:
         await ctx.respond("Your search found no quotes.")
 
 
+@plugin.listener(hikari.InteractionCreateEvent)
+async def on_search_page_interaction(event: hikari.InteractionCreateEvent) -> None:
+    if not isinstance(event.interaction, hikari.ComponentInteraction) or not event.interaction.custom_id.startswith(
+            _SEARCH_PAGE_PREFIX):
+        return
+    search_id, page = map(int, event.interaction.custom_id.removeprefix(_SEARCH_PAGE_PREFIX).split(':'))
+    search = _searches.get(search_id)
+    if search is None or page >= len(search.page_starts):
+        embed, component = None, None
+    else:
+        embed, component = await _get_search_page(event.app, search_id, search, page)
+    if embed:
+        await event.interaction.create_initial_response(
+            hikari.ResponseType.MESSAGE_UPDATE, embed=embed, component=component)
+    else:
+        await event.interaction.create_initial_response(
+            hikari.ResponseType.MESSAGE_UPDATE, "This search has expired. Please search again.",
+            embeds=[], components=[])
+
+
 @quotes_group.child
 @lightbulb.option("quote_id", description="ID of quote to post", type=int)
 @lightbulb.command("get", description="Get a specific quote by ID and post it publicly.")
@@ -88,8 +131,7 @@ async def quotes_find(ctx: lightbulb.SlashContext) -> None:
 async def quotes_get(ctx: lightbulb.SlashContext) -> None:
     try:
         quote = await Quote.get(guild_id=ctx.guild_id, id=ctx.options.quote_id)
-        user = ctx.get_guild().get_member(quote.user_id)
-        await ctx.respond(f"{user.display_name} said:\n>>> {quote.content}")
+        await ctx.respond(f"{_get_display_name(ctx.app, ctx.guild_id, quote.user_id)} said:\n>>> {quote.content}")
     except tortoise.exceptions.DoesNotExist as e:
         raise UserError(f"Quote ID {ctx.options.quote_id} does not exist.") from e
 
@@ -100,12 +142,48 @@ async def quotes_get(ctx: lightbulb.SlashContext) -> None:
 @lightbulb.implements(lightbulb.SlashSubCommand)
 async def delete(ctx: lightbulb.SlashContext) -> None:
     deleted_count = await Quote.filter(guild_id=ctx.guild_id, id=ctx.options.quote_id).delete()
+    _random_quotes.invalidate(guild_id=ctx.guild_id)
     if deleted_count:
         await ctx.respond(f"Deleted quote with ID {ctx.options.quote_id}.")
     else:
         raise UserError(f"Quote ID {ctx.options.quote_id} does not exist.")
 
 
+@quotes_group.child
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.option("file", description="JSON lines or CSV file with user_id, content and optionally added_by",
+                  type=hikari.Attachment)
+@lightbulb.command("import", description="Import quotes from a file.", ephemeral=True)
+@lightbulb.implements(lightbulb.SlashSubCommand)
+async def quotes_import(ctx: lightbulb.SlashContext) -> None:
+    attachment: hikari.Attachment = ctx.options.file
+    format = attachment.filename.rpartition('.')[2].lower()
+    if format not in quote_transfer.FORMATS:
+        raise UserError(f"Unsupported file type, use one of: {', '.join(quote_transfer.FORMATS)}.")
+    await ctx.respond(hikari.ResponseType.DEFERRED_MESSAGE_CREATE)
+    try:
+        data = io.StringIO((await attachment.read()).decode('utf-8-sig'))
+        read, inserted = await quote_transfer.import_quotes(
+            ctx.guild_id, quote_transfer.read_quotes(data, format), default_added_by=ctx.author.id)
+    except (quote_transfer.QuoteFormatError, ValueError) as e:
+        raise UserError(f"Could not import quotes: {e}") from e
+    _random_quotes.invalidate(guild_id=ctx.guild_id)
+    await ctx.respond(f"Imported {inserted} new quotes, skipped {read - inserted} that already exist.")
+
+
+@quotes_group.child
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.option("format", description="File format", choices=quote_transfer.FORMATS, default='jsonl')
+@lightbulb.command("export", description="Export all quotes of this server to a file.", ephemeral=True)
+@lightbulb.implements(lightbulb.SlashSubCommand)
+async def quotes_export(ctx: lightbulb.SlashContext) -> None:
+    await ctx.respond(hikari.ResponseType.DEFERRED_MESSAGE_CREATE)
+    output = io.BytesIO()
+    count = await quote_transfer.export_quotes(ctx.guild_id, ctx.options.format, output)
+    await ctx.respond(f"Exported {count} quotes.",
+                      attachment=hikari.Bytes(output.getvalue(), f"quotes-{ctx.guild_id}.{ctx.options.format}"))
+
+
 @plugin.command
 @lightbulb.add_cooldown(120, 3, lightbulb.GuildBucket, cls=CooldownManager)
 @lightbulb.option("user", description="User to get quotes for", type=hikari.Member)
@@ -140,14 +218,63 @@ async def quote_corgi(ctx: lightbulb.SlashContext) -> None:
 async def on_member_leave(event: hikari.MemberDeleteEvent) -> None:
     """Remove history about the member if they leave."""
     await Quote.filter(guild_id=event.guild_id, user_id=event.user_id).delete()
+    _random_quotes.invalidate(guild_id=event.guild_id, user_id=event.user_id)
 
 
 async def _get_quote(guild_id: int, user_id: int) -> str:
-    quote = await Quote.filter(guild_id=guild_id, user_id=user_id).annotate(
-        random=Random("id")).order_by("random").only("content").first()
+    quote = await _random_quotes.pick("content", guild_id=guild_id, user_id=user_id)
     if quote:
         return quote.content
     else:
         raise UserError("This user has no quotes.")
 
+
+async def _get_search_page(
+    app: lightbulb.BotApp, search_id: int, search: _QuoteSearch, page: int,
+) -> tuple[hikari.Embed | None, hikari.api.MessageActionRowBuilder | None]:
+    quotes = await _search_quotes(search, search.page_starts[page], _SEARCH_PAGE_SIZE + 1)
+    if not quotes:
+        return None, None
+    has_next_page = len(quotes) > _SEARCH_PAGE_SIZE
+    quotes = quotes[:_SEARCH_PAGE_SIZE]
+    if has_next_page and len(search.page_starts) == page + 1:
+        search.page_starts.append((quotes[-1].get('rank', 0), quotes[-1]['id']))
+
+    embed = hikari.Embed()
+    for quote in quotes:
+        embed.add_field(name=f"[{quote['id']}] {_get_display_name(app, search.guild_id, quote['user_id'])}",
+                        value=quote['content'], inline=False)
+    embed.set_footer(f"Page {page + 1}")
+    component = app.rest.build_message_action_row()
+    component.add_interactive_button(hikari.ButtonStyle.SECONDARY, f"{_SEARCH_PAGE_PREFIX}{search_id}:{page - 1}",
+                                     label="Previous", is_disabled=page == 0)
+    component.add_interactive_button(hikari.ButtonStyle.SECONDARY, f"{_SEARCH_PAGE_PREFIX}{search_id}:{page + 1}",
+                                     label="Next", is_disabled=not has_next_page)
+    return embed, component
+
+
+def _get_display_name(app: lightbulb.BotApp, guild_id: int, user_id: int) -> str:
+    # Only members of guilds we own are cached, and quoted members may have left
+    if member := app.cache.get_member(guild_id, user_id):
+        return member.display_name
+    if user := app.cache.get_user(user_id):
+        return user.username
+    return f"User {user_id}"
+
+
+async def _search_quotes(search: _QuoteSearch, after: tuple[float, int] | None, limit: int) -> list[dict]:
+    if search.text:
+        rank, quote_id = after or (None, None)
+        _, rows = await tortoise.connections.get("default").execute_query(
+            _SEARCH_QUERY, [search.guild_id, search.user_id, search.text, rank, quote_id, limit])
+        return [dict(row) for row in rows]
+    # Without words to rank by, the newest quotes come first
+    query = Quote.filter(guild_id=search.guild_id).order_by("-id").limit(limit)
+    if search.user_id:
+        query = query.filter(user_id=search.user_id)
+    if after:
+        query = query.filter(id__lt=after[1])
+    return await query.values("id", "user_id", "content")
+
+
 load, unload = plugin.export_extension()
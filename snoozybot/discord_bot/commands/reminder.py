@@ -38,8 +38,9 @@ async def reminder_set(ctx: lightbulb.SlashContext) -> None:
                         f'Try something like "3 minutes" or "2 days"')
     if time <= datetime.now():
         raise UserError("You need to specify a time in the future.")
-    async with tortoise.transactions.in_transaction() as tx:
+    async with tortoise.transactions.in_transaction('default') as tx:
         task = ScheduledTask(guild_id=ctx.guild_id, task_type=TaskType.REMINDER, process_after=time,
+                             user_id=ctx.user.id,
                              payload={'channel': ctx.channel_id, 'user': ctx.user.id, 'reason': ctx.options.about})
         await task.save(using_db=tx)
         await ctx.respond(f"All set. I will remind you in this channel about {ctx.options.about} "
@@ -55,7 +56,7 @@ async def cancel(ctx: lightbulb.SlashContext) -> None:
         pk=ctx.options.id,
         guild_id=ctx.guild_id,
         task_type=TaskType.REMINDER,
-        payload__contains={'user': ctx.user.id}
+        user_id=ctx.user.id
     ).delete()
     if deleted_count:
         await ctx.respond("I have cancelled that reminder.")
@@ -67,8 +68,8 @@ async def cancel(ctx: lightbulb.SlashContext) -> None:
 @lightbulb.command("list", description="List your existing reminders.", ephemeral=True)
 async def list(ctx: lightbulb.SlashContext) -> None:
     reminders = await ScheduledTask.filter(
-        guild_id=ctx.guild_id, task_type=TaskType.REMINDER, payload__contains={'user': ctx.user.id}
-    ).all()
+        guild_id=ctx.guild_id, user_id=ctx.user.id, task_type=TaskType.REMINDER
+    ).order_by('process_after')
     if reminders:
         rows = (f'[{r.pk}] <t:{int(r.process_after.timestamp())}:f> {r.payload["reason"]}' for r in reminders)
         await ctx.respond("You have these reminders:\n" + '\n'.join(rows))
@@ -78,7 +79,7 @@ async def list(ctx: lightbulb.SlashContext) -> None:
 
 @plugin.periodic_task(timedelta(minutes=1))
 async def check_and_send_reminder(app: lightbulb.BotApp):
-    async with tortoise.transactions.in_transaction() as tx:
+    async with tortoise.transactions.in_transaction('default') as tx:
         db_records = await ScheduledTask.select_for_update().using_db(tx).filter(
             guild_id__in=app.default_enabled_guilds,
             task_type=TaskType.REMINDER,
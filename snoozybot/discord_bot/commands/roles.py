@@ -16,7 +16,7 @@ from snoozybot.exceptions import UserError
 from snoozybot.utils import LightbulbPlugin
 
 logger = logging.getLogger(__name__)
-plugin = LightbulbPlugin('roles')
+plugin = LightbulbPlugin('roles', intents=hikari.Intents.GUILD_MESSAGES | hikari.Intents.MESSAGE_CONTENT)
 _MOD_DROPDOWN_PREFIX = 'roles:mod_assign:'
 _SELF_DROPDOWN_PREFIX = 'roles:self_assign:'
 
@@ -297,6 +297,7 @@ async def on_component_interaction(event: hikari.InteractionCreateEvent) -> None
                     guild_id=member.guild_id,
                     task_type=TaskType.REMOVE_ROLE,
                     process_after=expiration,
+                    user_id=member.id,
                     payload={'role': role.id, 'user': member.id}
                 ).save()
                 response += f'It will be automatically removed around <t:{int(expiration.timestamp())}:f>.'
@@ -352,7 +353,7 @@ async def _member_ineligible_reason(member: hikari.Member, desired_role_id: int)
 
 @plugin.periodic_task(timedelta(minutes=5))
 async def auto_role_removal(app: lightbulb.BotApp):
-    async with tortoise.transactions.in_transaction() as tx:
+    async with tortoise.transactions.in_transaction('default') as tx:
         records = await ScheduledTask.select_for_update().using_db(tx).filter(
             guild_id__in=app.default_enabled_guilds,
             task_type=TaskType.REMOVE_ROLE,
@@ -7,6 +7,7 @@ import lightbulb
 import pytz
 from parsedatetime import parsedatetime
 
+from snoozybot.database.birthdays import refresh_user_birthdays
 from snoozybot.database.models import User
 from snoozybot.exceptions import UserError
 from snoozybot.utils import LightbulbPlugin
@@ -32,6 +33,8 @@ async def timezone_set(ctx: lightbulb.SlashContext):
     timezone = ctx.options.timezone.strip()
     tz = _parse_timezone(timezone)
     await User.update_or_create({"timezone": str(tz)}, user_id=ctx.user.id)
+    # Birthdays are at local midnight, so they move along with the timezone
+    await refresh_user_birthdays(ctx.user.id)
     await ctx.respond(f"Done! Your timezone is now set to {str(tz)}.")
 
 
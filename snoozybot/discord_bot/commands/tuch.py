@@ -4,9 +4,9 @@ import hikari
 import lightbulb
 import tortoise.transactions
 from prettytable import PrettyTable
-from tortoise import connections
 from tortoise.functions import Sum
 
+from snoozybot.database import replica
 from snoozybot.database.models import Tuch
 from snoozybot.utils import LightbulbPlugin
 
@@ -25,7 +25,7 @@ async def tuch(ctx: lightbulb.SlashContext) -> None:
         await ctx.respond(
             f"{ctx.member.display_name} tuches {choice(ctx.get_channel().members).display_name}'s butt, " f"OwO"
         )
-    async with tortoise.transactions.in_transaction() as tx:
+    async with tortoise.transactions.in_transaction('default') as tx:
         record, _ = await Tuch.get_or_create(guild_id=ctx.guild_id, user_id=ctx.author.id, using_db=tx)
         record.max_butts = max(record.max_butts, number)
         record.total_butts += number
@@ -57,7 +57,7 @@ async def tuchboard(ctx: lightbulb.SlashContext) -> None:
     WHERE rank <= 10
     """
 
-    connection = connections.get("default")
+    connection = replica.get_read_connection(Tuch)
     data = await connection.execute_query_dict(query, [ctx.guild_id])
     table = PrettyTable()
     table.field_names = ("Rank", "User", "Max Butts", "Total Butts")
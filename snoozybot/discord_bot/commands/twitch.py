@@ -1,38 +1,269 @@
 import asyncio
 import logging
 import string
+import typing
 from collections import defaultdict
+from collections.abc import Iterable
 from datetime import datetime, timedelta
 from email.utils import parsedate_to_datetime
 
 import hikari
 import lightbulb
 import twitchio
+from cachetools import TTLCache
+from twitchio.ext import eventsub
 
 from snoozybot.config import values
+from snoozybot.config.env import envConfig
 from snoozybot.config.provider import get_secret_configs
-from snoozybot.utils import LightbulbPlugin, get_client_session
+from snoozybot.database.poller_state import PollerStateStore
+from snoozybot.http_client import http_client
+from snoozybot.utils import LightbulbPlugin
 
-plugin = LightbulbPlugin('twitch')
+plugin = LightbulbPlugin('twitch', enabled_by=[values.twitch_online_notif_enabled])
 twitch: twitchio.Client = None  # type: ignore
-_LAST_KNOWN_STREAM_ID: dict[str, int] = {}
+twitch_eventsub: eventsub.EventSubClient | None = None
+_LAST_KNOWN_STREAM_ID = PollerStateStore('twitch.stream_id')  # -1 if not live
+_NOTIFY_LOGIN_GUILDS: dict[lightbulb.BotApp, dict[str, set[int]]] = {}
+_LAST_POLLED: dict[lightbulb.BotApp, datetime] = {}
+_EVENTSUB_SUBSCRIPTIONS: dict[int, str] = {}  # broadcaster user id -> subscription id
+_EVENTSUB_POLL_INTERVAL = timedelta(minutes=30)
+_STREAM_PREVIEWS: TTLCache = TTLCache(maxsize=64, ttl=3600)  # stream id -> task getting its preview image
 logger = logging.getLogger(__name__)
 
 
+class TwitchMetadataCache:
+    """
+    Cache of twitch team rosters and user profiles, which rarely change. Expired team rosters are still served while
+    they are refreshed in the background; expired users are fetched again on next use.
+    """
+
+    def __init__(self, ttl: timedelta) -> None:
+        self._ttl = ttl
+        self._teams: dict[str, tuple[datetime, list[str]]] = {}
+        self._users_by_id: dict[int, tuple[datetime, twitchio.User]] = {}
+        self._users_by_login: dict[str, tuple[datetime, twitchio.User]] = {}
+        self._refreshing_teams: dict[str, asyncio.Task] = {}  # also keeps the tasks from being garbage collected
+
+    async def get_team_logins(self, team_name: str) -> list[str]:
+        team_name = team_name.lower()
+        if team_name not in self._teams:
+            return await self._refresh_team(team_name)
+        fetched_at, logins = self._teams[team_name]
+        if datetime.now() - fetched_at > self._ttl and team_name not in self._refreshing_teams:
+            self._refreshing_teams[team_name] = asyncio.create_task(self._refresh_team(team_name))
+        return logins
+
+    async def get_users_by_id(self, ids: Iterable[int]) -> dict[int, twitchio.User]:
+        ids = {int(i) for i in ids}
+        missing = [i for i in ids if not self._is_fresh(self._users_by_id.get(i))]
+        for i in range(0, len(missing), 100):
+            self._store_users(await twitch.fetch_users(ids=missing[i:i + 100]))
+        return {i: self._users_by_id[i][1] for i in ids if i in self._users_by_id}
+
+    async def get_users_by_login(self, logins: Iterable[str]) -> dict[str, twitchio.User]:
+        logins = {login.lower() for login in logins}
+        missing = [login for login in logins if not self._is_fresh(self._users_by_login.get(login))]
+        for i in range(0, len(missing), 100):
+            self._store_users(await twitch.fetch_users(names=missing[i:i + 100]))
+        return {login: self._users_by_login[login][1] for login in logins if login in self._users_by_login}
+
+    async def _refresh_team(self, team_name: str) -> list[str]:
+        try:
+            team = await twitch.fetch_teams(team_name=team_name)
+            logins = [user.name.lower() for user in team.users]
+            self._teams[team_name] = (datetime.now(), logins)
+            logger.info('Fetched twitch team %s with %d members.', team_name, len(logins))
+            return logins
+        except Exception:
+            if team_name not in self._teams:
+                raise
+            logger.exception('Failed to refresh twitch team %s; using cached members.', team_name)
+            return self._teams[team_name][1]
+        finally:
+            self._refreshing_teams.pop(team_name, None)
+
+    def _store_users(self, users: list[twitchio.User]) -> None:
+        now = datetime.now()
+        for user in users:
+            self._users_by_id[user.id] = self._users_by_login[user.name.lower()] = (now, user)
+
+    def _is_fresh(self, entry: tuple[datetime, typing.Any] | None) -> bool:
+        return entry is not None and datetime.now() - entry[0] <= self._ttl
+
+
+twitch_metadata = TwitchMetadataCache(ttl=timedelta(hours=6))
+
+
+class StreamStatusService:
+    """
+    Looks up which twitch logins are live. Lookups made within a short window of each other are batched into single
+    Helix requests of up to 100 logins, and recent results (including offline ones) are served from cache.
+    """
+
+    def __init__(self, window: float, ttl: timedelta) -> None:
+        self._window = window
+        self._ttl = ttl
+        self._cache: dict[str, tuple[datetime, twitchio.Stream | None]] = {}
+        self._pending: dict[str, asyncio.Future[twitchio.Stream | None]] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    async def get_streams(self, logins: Iterable[str]) -> dict[str, twitchio.Stream]:
+        """Returns the live streams for the given logins, keyed by login. Offline logins are left out."""
+        results: dict[str, twitchio.Stream | None] = {}
+        waiting: dict[str, asyncio.Future[twitchio.Stream | None]] = {}
+        now = datetime.now()
+        wanted = {login.lower() for login in logins}
+        for login in wanted:
+            cached = self._cache.get(login)
+            if cached and now - cached[0] <= self._ttl:
+                results[login] = cached[1]
+            else:
+                if login not in self._pending:
+                    self._pending[login] = asyncio.get_running_loop().create_future()
+                waiting[login] = self._pending[login]
+        if waiting:
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush())
+            streams = await asyncio.gather(*(asyncio.shield(future) for future in waiting.values()))
+            results.update(zip(waiting.keys(), streams))
+        return {login: stream for login, stream in results.items() if stream is not None}
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self._window)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+        logins = list(pending.keys())
+        for i in range(0, len(logins), 100):
+            batch = logins[i:i + 100]
+            try:
+                streams = await twitch.fetch_streams(user_logins=batch, type='live')
+            except Exception as e:
+                for login in batch:
+                    pending[login].set_exception(e)
+                continue
+            now = datetime.now()
+            live = {stream.user.name.lower(): stream for stream in streams}
+            for login in batch:
+                self._cache[login] = (now, live.get(login))
+                pending[login].set_result(live.get(login))
+
+
+stream_status = StreamStatusService(window=1.0, ttl=timedelta(minutes=1))
+
+
 @plugin.listener(hikari.StartingEvent)
 async def on_started(event: hikari.StartingEvent):
     global twitch
-    _twitch_client_id_secret = await get_secret_configs('secret.twitch.client_id_secret')
-    _twitch_client_id, _twitch_client_secret = next(iter(_twitch_client_id_secret.values())).get_secret_value().split()
-    twitch = twitchio.Client.from_client_credentials(_twitch_client_id, _twitch_client_secret)
-    logger.info('Started twitchIO client.')
+    await _LAST_KNOWN_STREAM_ID.load()
+    if twitch is None:
+        _twitch_client_id_secret = await get_secret_configs('secret.twitch.client_id_secret')
+        _twitch_client_id, _twitch_client_secret = next(
+            iter(_twitch_client_id_secret.values())).get_secret_value().split()
+        twitch = twitchio.Client.from_client_credentials(_twitch_client_id, _twitch_client_secret)
+        logger.info('Started twitchIO client.')
+    if twitch_eventsub is None and envConfig.twitch_eventsub_port:
+        await _start_eventsub(event.app)
+
+
+@plugin.listener(hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent):
+    global twitch_eventsub
+    _NOTIFY_LOGIN_GUILDS.pop(event.app, None)
+    if twitch_eventsub is not None and not _NOTIFY_LOGIN_GUILDS:
+        twitch_eventsub.stop()
+        twitch.remove_event(_on_eventsub_stream_online)
+        twitch.remove_event(_on_eventsub_revocation)
+        _EVENTSUB_SUBSCRIPTIONS.clear()  # loaded from twitch again on the next start
+        twitch_eventsub = None
+
+
+async def _start_eventsub(app: lightbulb.BotApp) -> None:
+    """
+    Start receiving stream.online notifications from twitch eventsub webhooks. Twitch must be able to reach the
+    callback URL, which should be proxied to the local port set in the environment.
+    """
+    global twitch_eventsub
+    eventsub_secret = await get_secret_configs('secret.twitch.eventsub')
+    if not eventsub_secret:
+        logger.warning('Twitch eventsub port is set, but secret.twitch.eventsub is not configured. Polling only.')
+        return
+    callback_url, webhook_secret = next(iter(eventsub_secret.values())).get_secret_value().split()
+    twitch_eventsub = _create_eventsub_client(callback_url, webhook_secret)
+    app.create_task(twitch_eventsub.listen(port=envConfig.twitch_eventsub_port, handle_signals=False))
+    # Pick up subscriptions made by previous runs of the bot so they're not duplicated
+    for sub in await twitch_eventsub.get_subscriptions(sub_type=eventsub.SubscriptionTypes.stream_start[0]):
+        if sub.transport.callback != callback_url:
+            continue
+        if sub.status == 'enabled' or sub.status == 'webhook_callback_verification_pending':
+            _EVENTSUB_SUBSCRIPTIONS[int(sub.condition['broadcaster_user_id'])] = sub.id
+        else:
+            await twitch_eventsub.delete_subscription(sub.id)
+    logger.info('Started twitch eventsub receiver on port %s with %d existing subscriptions.',
+                envConfig.twitch_eventsub_port, len(_EVENTSUB_SUBSCRIPTIONS))
+
+
+def _create_eventsub_client(callback_url: str, webhook_secret: str) -> eventsub.EventSubClient:
+    client = eventsub.EventSubClient(twitch, webhook_secret=webhook_secret, callback_route=callback_url)
+    twitch.add_event(_on_eventsub_stream_online, 'event_eventsub_notification_stream_start')
+    twitch.add_event(_on_eventsub_revocation, 'event_eventsub_revokation')  # sic
+    return client
+
+
+async def _sync_eventsub_subscriptions(client: eventsub.EventSubClient) -> None:
+    """Subscribe to every login any bot wants notifications for, and unsubscribe from the rest."""
+    logins = set().union(*_NOTIFY_LOGIN_GUILDS.values())
+    wanted = {user.id for user in (await twitch_metadata.get_users_by_login(logins)).values()}
+    for user_id in wanted - _EVENTSUB_SUBSCRIPTIONS.keys():
+        subscription = await client.subscribe_channel_stream_start(user_id)
+        _EVENTSUB_SUBSCRIPTIONS[user_id] = subscription[0]['id']
+        logger.info('Subscribed to twitch eventsub stream.online for user %s', user_id)
+    for user_id in _EVENTSUB_SUBSCRIPTIONS.keys() - wanted:
+        await client.delete_subscription(_EVENTSUB_SUBSCRIPTIONS.pop(user_id))
+        logger.info('Unsubscribed from twitch eventsub stream.online for user %s', user_id)
+
+
+async def _on_eventsub_revocation(event: eventsub.RevokationEvent) -> None:
+    # e.g. the user was banned or renamed their account, or twitch gave up on delivering to us
+    subscription = event.subscription
+    user_id = int(subscription.condition['broadcaster_user_id'])
+    logger.warning('Twitch revoked eventsub subscription %s for user %s: %s', subscription.id, user_id,
+                   subscription.status)
+    if _EVENTSUB_SUBSCRIPTIONS.get(user_id) == subscription.id:
+        del _EVENTSUB_SUBSCRIPTIONS[user_id]  # subscribe again on the next sync
+
+
+async def _on_eventsub_stream_online(event: eventsub.NotificationEvent) -> None:
+    data: eventsub.StreamOnlineData = event.data
+    if data.type != 'live':
+        return
+    # Stream info may take a moment to show up in the API after the online event.
+    streams: list[twitchio.Stream] = []
+    for _ in range(6):
+        streams = await twitch.fetch_streams(user_ids=[data.broadcaster.id], type='live')
+        if streams:
+            break
+        await asyncio.sleep(10)
+    else:
+        logger.warning('Received twitch stream.online for %s, but the stream was not found.', data.broadcaster.id)
+        return
+    stream = streams[0]
+    login = stream.user.name.lower()
+    if _LAST_KNOWN_STREAM_ID.get(login) == stream.id:
+        return  # Already notified; either a retried delivery or polling got there first
+    _LAST_KNOWN_STREAM_ID[login] = stream.id
+    logger.info('Received twitch eventsub stream.online for %s, sending notifications...', login)
+    users = await twitch_metadata.get_users_by_id([stream.user.id])
+    await asyncio.gather(*(
+        _process_stream_notif(stream=stream, user=users[stream.user.id], guild=guild, app=app)
+        for app, login_guilds in _NOTIFY_LOGIN_GUILDS.items() for guild in login_guilds.get(login, ())
+    ))
 
 
 async def _get_guild_notify_logins(guild: int) -> list[str]:
-    logins = await values.twitch_online_notif_logins.get_value(guild) or []
-    if team_name := await values.twitch_online_notif_team.get_value(guild):
-        team = await twitch.fetch_teams(team_name=team_name)
-        logins.extend(user.name for user in team.users)
+    logins = list(await values.twitch_online_notif_logins.get_value(guild) or [])  # copy; don't modify cached config
+    for team_name in await values.twitch_online_notif_team.get_value(guild) or []:
+        logins.extend(await twitch_metadata.get_team_logins(team_name))
     return logins
 
 
@@ -41,11 +272,7 @@ async def _check_twitch_stream_live(logins: list[str]) -> list[twitchio.Stream]:
     # Does not return streamers whose status went from unknown to online.
     if not logins:
         return []
-    batches = await asyncio.gather(*(
-        twitch.fetch_streams(user_logins=logins[i:i + 100], type='live')
-        for i in range(0, len(logins), 100)
-    ))
-    streams = [s for b in batches for s in b]
+    streams = list((await stream_status.get_streams(logins)).values())
     results = []
     for stream in streams:
         user = stream.user.name.lower()
@@ -67,7 +294,7 @@ async def _get_stream_preview_image(url: str, stream_started_at: datetime) -> by
     intervals until the received image's timestamp ("date" http header) is AFTER the stream's start time.
     """
     for _ in range(20):
-        async with get_client_session().get(url, allow_redirects=False) as resp:
+        async with http_client.get(url, allow_redirects=False) as resp:
             # Disallow redirects; redirects go to the 404 image.
             if 'date' not in resp.headers:
                 continue  # bad response?
@@ -86,17 +313,18 @@ async def _get_stream_preview_image(url: str, stream_started_at: datetime) -> by
 
 
 async def _generate_stream_embed(stream: twitchio.Stream, guild_id: int, user: twitchio.User) -> hikari.Embed:
+    """
+    Generates the embed for a live stream. The twitch thumbnail is not included because it may take minutes before
+    a fresh one is available; attach it to the sent message later with _attach_stream_previews.
+    """
     embed = hikari.Embed(
         title=stream.title,
         description=stream.game_name,
         url='https://www.twitch.tv/' + stream.user.name,
     )
     embed.set_author(name=stream.user.name)
-    image_url = (await values.twitch_online_notif_image_url.get_value(guild_id)
-                 or stream.thumbnail_url.format(width=720, height=400))
-    image_data = await _get_stream_preview_image(image_url, stream.started_at)
-    if image_data:
-        embed.set_image(hikari.Bytes(image_data, 'stream_preview.jpg', mimetype='image/jpeg'))
+    if image_url := await values.twitch_online_notif_image_url.get_value(guild_id):
+        embed.set_image(image_url)
     embed.timestamp = stream.started_at
     if stream.tags:
         embed.set_footer(text=', '.join(stream.tags))
@@ -104,6 +332,36 @@ async def _generate_stream_embed(stream: twitchio.Stream, guild_id: int, user: t
     return embed
 
 
+def _get_cached_stream_preview(stream: twitchio.Stream) -> asyncio.Task[bytes | None]:
+    """Downloads the stream preview image once per stream, no matter how many messages need it."""
+    if stream.id not in _STREAM_PREVIEWS:
+        url = stream.thumbnail_url.format(width=720, height=400)
+        _STREAM_PREVIEWS[stream.id] = asyncio.create_task(_get_stream_preview_image(url, stream.started_at))
+    return _STREAM_PREVIEWS[stream.id]
+
+
+async def _attach_stream_previews(message: hikari.Message, streams: list[twitchio.Stream]) -> None:
+    """Edits an already sent message to add the stream preview images to each stream's embed."""
+    try:
+        images = await asyncio.gather(*(_get_cached_stream_preview(stream) for stream in streams))
+        embeds = list(message.embeds)
+        attached = False
+        for stream, image_data in zip(streams, images):
+            stream_url = 'https://www.twitch.tv/' + stream.user.name
+            # Skip embeds that already have an image; the guild has its own image configured.
+            embed = next((e for e in embeds if e.url == stream_url and not e.image), None)
+            if embed and image_data:
+                embed.set_image(hikari.Bytes(image_data, f'stream_preview_{stream.id}.jpg', mimetype='image/jpeg'))
+                attached = True
+        if attached:
+            await message.edit(embeds=embeds)
+            logger.info('Attached stream previews to message %s in channel %s', message.id, message.channel_id)
+    except Exception:
+        # This runs in the background; log instead of losing the exception.
+        logger.exception('Failed to attach stream previews to message %s in channel %s',
+                         message.id, message.channel_id)
+
+
 async def _process_stream_notif(stream: twitchio.Stream, user: twitchio.User, guild: int, app: lightbulb.BotApp):
     embed = await _generate_stream_embed(stream, guild, user)
     content_template = string.Template(await values.twitch_online_notif_title_template.get_value(guild) or '')
@@ -111,10 +369,11 @@ async def _process_stream_notif(stream: twitchio.Stream, user: twitchio.User, gu
     channel_id = await values.twitch_online_notif_channel_id.get_value(guild)
     channel = app.cache.get_guild_channel(channel_id)
     if isinstance(channel, hikari.TextableChannel):
-        await channel.send(content=content, embed=embed, user_mentions=True, role_mentions=True,
-                           mentions_everyone=True)
+        message = await channel.send(content=content, embed=embed, user_mentions=True, role_mentions=True,
+                                     mentions_everyone=True)
         logger.info('Sent stream live notification to guild %s channel %s for twitch channel %s',
                     guild, channel_id, stream.user.id)
+        app.create_task(_attach_stream_previews(message, [stream]))
     else:
         logger.error('Did not send a stream live notification for guild %s channel %s: invalid channel ID',
                      guild, channel)
@@ -129,19 +388,26 @@ async def twitch_online_notif(app: lightbulb.BotApp):
             logins = await _get_guild_notify_logins(guild)
             for login in logins or []:
                 login_guilds[login.lower()].add(guild)
+    _NOTIFY_LOGIN_GUILDS[app] = login_guilds
 
     try:
+        if twitch_eventsub is not None:
+            # Eventsub sends notifications as they happen. Polling is only a fallback for missed events.
+            await _sync_eventsub_subscriptions(twitch_eventsub)
+            if datetime.now() - _LAST_POLLED.get(app, datetime.min) < _EVENTSUB_POLL_INTERVAL:
+                return
+        _LAST_POLLED[app] = datetime.now()
         # Check which streams went from offline to online on twitch
         started_streams = await _check_twitch_stream_live(list(login_guilds.keys()))
         if not started_streams:
             return
         # Generate embeds and send
         logger.info('Found newly started twitch streams: %s, sending notifications...', started_streams)
-        users: list[twitchio.User] = await twitch.fetch_users(ids=[stream.user.id for stream in started_streams])
+        users = await twitch_metadata.get_users_by_id(stream.user.id for stream in started_streams)
         await asyncio.gather(*(
             _process_stream_notif(
                 stream=stream,
-                user=next(u for u in users if u.id == stream.user.id),
+                user=users[stream.user.id],
                 guild=guild,
                 app=app,
             ) for stream in started_streams for guild in login_guilds[stream.user.name.lower()]))
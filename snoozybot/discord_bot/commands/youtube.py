@@ -1,91 +1,319 @@
 import asyncio
+import hmac
 import logging
+import re
 import string
+import typing
 from collections import defaultdict
-from datetime import timedelta
+from collections.abc import Callable, Coroutine
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
 
+import aiohttp
 import hikari
 import lightbulb
-from aiohttp import ClientSession
+import yarl
+from aiohttp import web
 
 from snoozybot.config import values
+from snoozybot.config.env import envConfig
 from snoozybot.config.provider import get_secret_configs
+from snoozybot.database.poller_state import PollerStateStore
+from snoozybot.http_client import http_client
 from snoozybot.utils import LightbulbPlugin
 
-plugin = LightbulbPlugin('youtube')
-_KNOWN_PLAYLIST_VIDEOS: dict[str, set[str]] = {}
+plugin = LightbulbPlugin('youtube', enabled_by=[values.youtube_notif_enabled])
+_PLAYLIST_STATES = PollerStateStore('youtube.playlist')
+_PLAYLIST_LOCKS: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+_PLAYLIST_CHANNELS: dict[str, str | None] = {}
+_NOTIFY_PLAYLIST_GUILDS: dict[lightbulb.BotApp, dict[str, set[int]]] = {}
+_LAST_POLLED: dict[lightbulb.BotApp, datetime] = {}
+_MAX_PLAYLIST_PAGES = 4
+_API_URL = 'https://youtube.googleapis.com/youtube/v3/'
+_WEBSUB_HUB = 'https://pubsubhubbub.appspot.com/subscribe'
+_WEBSUB_TOPIC = 'https://www.youtube.com/xml/feeds/videos.xml?channel_id='
+_WEBSUB_LEASE = timedelta(days=5)
+_WEBSUB_RENEW_BEFORE = timedelta(days=1)
+_WEBSUB_POLL_INTERVAL = timedelta(hours=1)
+_CHANNEL_ID_PATTERN = re.compile(r'<yt:channelId>([\w-]+)</yt:channelId>')
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class PlaylistState:
+    """
+    What was seen of a playlist when it was last read: for uploads playlists, the ETag and public item IDs of its newest
+    page; for other playlists, the public item IDs of the whole playlist.
+    """
+    etag: str | None
+    recent_item_ids: list[str]
+
+
 class Youtube:
     def __init__(self) -> None:
         self.__api_key: str | None = None
-        self._client = ClientSession()
 
     def set_api_key(self, key: str) -> None:
         self.__api_key = key
 
     async def _get_youtube_api(self, resource: str, params: dict) -> dict:
-        async with self._client.get('https://youtube.googleapis.com/youtube/v3/' + resource, params=params, headers={
-            'X-Goog-Api-Key': self.__api_key,
-        }) as resp:
+        async with self._get(resource, params, {}) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def _get_youtube_api_if_changed(self, resource: str, params: dict, etag: str | None) -> dict | None:
+        """Calls the youtube API, unless the resource still has the given etag: then returns None."""
+        async with self._get(resource, params, {'If-None-Match': etag} if etag else {}) as resp:
+            if resp.status == 304:
+                return None
             resp.raise_for_status()
             return await resp.json()
 
+    def _get(self, resource: str, params: dict,
+             headers: dict[str, str]) -> typing.AsyncContextManager[aiohttp.ClientResponse]:
+        return http_client.get(_API_URL + resource, params=params,
+                               headers={'X-Goog-Api-Key': self.__api_key or '', **headers})
+
+    async def get_new_playlist_videos(
+        self, playlist_id: str, state: PlaylistState | None,
+    ) -> tuple[list[str], PlaylistState]:
+        """
+        Returns the public item IDs that were added to a playlist since its previous state, with its new state. With
+        no previous state, nothing is considered new.
+        """
+        if playlist_id.startswith('UU'):
+            return await self._get_new_uploads(playlist_id, state)
+        # Other playlists can be in any order, and items can be added anywhere
+        item_ids = await self.get_all_playlist_videos(playlist_id)
+        known = set(state.recent_item_ids if state else item_ids)
+        return [item_id for item_id in item_ids if item_id not in known], PlaylistState(None, item_ids)
+
+    async def _get_new_uploads(self, playlist_id: str, state: PlaylistState | None) -> tuple[list[str], PlaylistState]:
+        """
+        Reads an uploads playlist, which lists newest items first, until reaching an item that was already known. Only
+        the newest page is read when there is no previous state or it has not changed since. When none of the known
+        items are found anymore, nothing is considered new either.
+        """
+        if state is None:
+            first_page = await self._get_youtube_api('playlistItems', _playlist_items_params(playlist_id, ''))
+            return [], PlaylistState(first_page.get('etag'), _public_item_ids(first_page))
+        data = await self._get_youtube_api_if_changed(
+            'playlistItems', _playlist_items_params(playlist_id, ''), state.etag)
+        if data is None:
+            return [], state  # playlist has not changed
+        new_state = PlaylistState(data.get('etag'), _public_item_ids(data))
+        known = set(state.recent_item_ids)
+        new_ids: list[str] = []
+        for page in range(1, _MAX_PLAYLIST_PAGES + 1):
+            for item_id in _public_item_ids(data):
+                if item_id in known:
+                    return new_ids, new_state
+                new_ids.append(item_id)
+            page_token = data.get('nextPageToken')
+            if page_token is None or page == _MAX_PLAYLIST_PAGES:
+                break
+            data = await self._get_youtube_api('playlistItems', _playlist_items_params(playlist_id, page_token))
+        if known:
+            # The known videos were removed or made private, so what's new can't be told apart from the rest of the
+            # playlist. Start over from its current state instead of announcing all of it.
+            logger.warning('Did not find any known videos in %d read pages of playlist %s, resetting its state.',
+                           page, playlist_id)
+            return [], new_state
+        return new_ids, new_state
+
     async def get_all_playlist_videos(self, playlist_id: str) -> list[str]:
         ids: list[str] = []
         page_token: str | None = ''
         while page_token is not None:
-            data = await self._get_youtube_api('playlistItems', {
-                'part': 'id,status', 'playlistId': playlist_id, 'maxResults': 50, 'pageToken': page_token
-            })
-            ids.extend(item['id'] for item in data['items'] if item['status']['privacyStatus'] == 'public')
+            data = await self._get_youtube_api('playlistItems', _playlist_items_params(playlist_id, page_token))
+            ids.extend(_public_item_ids(data))
             page_token = data.get('nextPageToken')
         return ids
 
     async def get_playlist_video_details(self, playlist_item_ids: list[str]) -> list[tuple[str, str]]:
-        data = await self._get_youtube_api('playlistItems', {
-            'part': 'snippet,status', 'id': ','.join(playlist_item_ids), 'maxResults': 50})
-        return [(item['snippet']['channelTitle'], item['snippet']['resourceId']['videoId']) for item in data['items']]
+        details: list[tuple[str, str]] = []
+        for i in range(0, len(playlist_item_ids), 50):
+            data = await self._get_youtube_api('playlistItems', {
+                'part': 'snippet,status', 'id': ','.join(playlist_item_ids[i:i + 50]), 'maxResults': 50})
+            details.extend((item['snippet']['channelTitle'], item['snippet']['resourceId']['videoId'])
+                           for item in data['items'])
+        return details
 
-    async def close(self):
-        await self._client.close()
+    async def get_playlist_channel_id(self, playlist_id: str) -> str | None:
+        if playlist_id.startswith('UU'):
+            # Uploads playlists map directly to their channel
+            return 'UC' + playlist_id[2:]
+        data = await self._get_youtube_api('playlists', {'part': 'snippet', 'id': playlist_id})
+        return data['items'][0]['snippet']['channelId'] if data['items'] else None
 
     @property
     def is_ready(self):
         return self.__api_key is not None
 
 
+def _playlist_items_params(playlist_id: str, page_token: str) -> dict:
+    return {'part': 'id,status', 'playlistId': playlist_id, 'maxResults': 50, 'pageToken': page_token}
+
+
+def _public_item_ids(data: dict) -> list[str]:
+    return [item['id'] for item in data['items'] if item['status']['privacyStatus'] == 'public']
+
+
+class YoutubeWebSub:
+    """
+    Receives upload notifications pushed by YouTube's WebSub (PubSubHubbub) hub. The hub must be able to reach the
+    callback URL, which should be proxied to the local port set in the environment.
+    """
+
+    def __init__(self, callback_url: str, secret: str,
+                 on_upload: Callable[[str], Coroutine[typing.Any, typing.Any, None]]) -> None:
+        self._callback_url = callback_url
+        self._secret = secret
+        self._on_upload = on_upload
+        self._leases: dict[str, datetime] = {}  # channel id -> lease expiry
+        self._upload_tasks: set[asyncio.Task] = set()
+        self._runner: web.AppRunner | None = None
+
+    async def start(self, port: int) -> None:
+        app = web.Application()
+        path = yarl.URL(self._callback_url).path
+        app.router.add_get(path, self._verify)
+        app.router.add_post(path, self._notify)
+        self._runner = web.AppRunner(app, handle_signals=False, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, port=port).start()
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+        for task in self._upload_tasks:
+            task.cancel()
+
+    async def sync(self, channel_ids: set[str]) -> None:
+        """Subscribe to (or renew) the given channels, and unsubscribe from all others."""
+        for channel_id in channel_ids:
+            previous_lease = self._leases.get(channel_id)
+            if (previous_lease or datetime.min) - datetime.now() < _WEBSUB_RENEW_BEFORE:
+                # Lease is confirmed when the hub verifies, which may happen before the request returns
+                self._leases[channel_id] = datetime.now() + _WEBSUB_LEASE
+                try:
+                    await self._request('subscribe', channel_id)
+                except Exception:
+                    logger.exception('Failed to request youtube websub subscription for channel %s', channel_id)
+                    if previous_lease is None:
+                        self._leases.pop(channel_id, None)  # try again on the next sync
+                    else:
+                        self._leases[channel_id] = previous_lease
+        for channel_id in self._leases.keys() - channel_ids:
+            del self._leases[channel_id]
+            try:
+                await self._request('unsubscribe', channel_id)
+            except Exception:
+                # The lease will expire by itself
+                logger.exception('Failed to request youtube websub unsubscription for channel %s', channel_id)
+
+    async def _request(self, mode: str, channel_id: str) -> None:
+        async with http_client.post(_WEBSUB_HUB, data={
+            'hub.callback': self._callback_url,
+            'hub.mode': mode,
+            'hub.topic': _WEBSUB_TOPIC + channel_id,
+            'hub.secret': self._secret,
+            'hub.lease_seconds': str(int(_WEBSUB_LEASE.total_seconds())),
+        }) as resp:
+            resp.raise_for_status()
+        logger.info('Requested youtube websub %s for channel %s', mode, channel_id)
+
+    async def _verify(self, request: web.Request) -> web.Response:
+        mode = request.query.get('hub.mode')
+        topic = request.query.get('hub.topic', '')
+        channel_id = topic.removeprefix(_WEBSUB_TOPIC)
+        if mode == 'subscribe' and channel_id in self._leases:
+            lease = int(request.query.get('hub.lease_seconds', _WEBSUB_LEASE.total_seconds()))
+            self._leases[channel_id] = datetime.now() + timedelta(seconds=lease)
+        elif mode != 'unsubscribe' or channel_id in self._leases:
+            return web.Response(status=404)
+        logger.info('Verified youtube websub %s for channel %s', mode, channel_id)
+        return web.Response(text=request.query.get('hub.challenge', ''))
+
+    async def _notify(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        signature = request.headers.get('X-Hub-Signature', '').removeprefix('sha1=')
+        expected = hmac.new(self._secret.encode(), body, 'sha1').hexdigest()
+        if not hmac.compare_digest(signature, expected):
+            logger.warning('Received youtube websub notification with an invalid signature.')
+            return web.Response(status=204)  # per spec, still acknowledge so the hub doesn't retry
+        for channel_id in set(_CHANNEL_ID_PATTERN.findall(body.decode(errors='replace'))):
+            task = asyncio.create_task(self._on_upload(channel_id))
+            self._upload_tasks.add(task)  # keep a reference until it's done, so that it isn't garbage collected
+            task.add_done_callback(self._upload_tasks.discard)
+        return web.Response(status=204)
+
+
 youtube = Youtube()
+youtube_websub: YoutubeWebSub | None = None
 
 
 @plugin.listener(hikari.StartedEvent)
 async def on_started(event: hikari.StartedEvent):
+    global youtube_websub
     api_key_config = await get_secret_configs('secret.youtube.api_key')
     api_key = next(iter(api_key_config.values())).get_secret_value()
     youtube.set_api_key(api_key)
     logger.info('Started youtube client.')
+    if youtube_websub is None and envConfig.youtube_websub_port:
+        websub_secret = await get_secret_configs('secret.youtube.websub')
+        if websub_secret:
+            callback_url, secret = next(iter(websub_secret.values())).get_secret_value().split()
+            youtube_websub = YoutubeWebSub(callback_url, secret, _on_websub_upload)
+            await youtube_websub.start(envConfig.youtube_websub_port)
+            logger.info('Started youtube websub receiver on port %s.', envConfig.youtube_websub_port)
+        else:
+            logger.warning('Youtube websub port is set, but secret.youtube.websub is not configured. Polling only.')
     await youtube_notif(event.app)
 
 
 @plugin.listener(hikari.StoppedEvent)
 async def on_stopped(event: hikari.StoppedEvent):
-    await youtube.close()
-
-
-async def _check_and_notify_youtube(playlist_id: str, guilds: set[int], app: lightbulb.BotApp):
-    logger.info('Checking new youtube videos for guild %s, playlist %s', guilds, playlist_id)
-    all_videos: set[str] = set(await youtube.get_all_playlist_videos(playlist_id))
-    if playlist_id not in _KNOWN_PLAYLIST_VIDEOS:
-        # First load of playlist; keep for later reference
-        _KNOWN_PLAYLIST_VIDEOS[playlist_id] = all_videos
-        logger.info('Initial load: %d videos in playlist %s', len(all_videos), playlist_id)
-    elif new_videos := all_videos - _KNOWN_PLAYLIST_VIDEOS[playlist_id]:
-        # There are new videos to notify
-        logger.info('Found new youtube videos %s in playlist %s, sending notifications...', new_videos, playlist_id)
-        _KNOWN_PLAYLIST_VIDEOS[playlist_id] = all_videos
-
-        for video_channel, video_id in await youtube.get_playlist_video_details(list(new_videos)):
+    _NOTIFY_PLAYLIST_GUILDS.pop(event.app, None)
+    if not _NOTIFY_PLAYLIST_GUILDS and youtube_websub:
+        await youtube_websub.stop()
+
+
+async def _on_websub_upload(channel_id: str) -> None:
+    """Checks the channel's playlists after the hub pushed an update for it."""
+    playlists = [playlist for playlist, channel in _PLAYLIST_CHANNELS.items() if channel == channel_id]
+    logger.info('Received youtube websub notification for channel %s, playlists %s', channel_id, playlists)
+    try:
+        # The push may arrive before the playlist API reflects the upload; check again a bit later if needed.
+        for delay in (0, 60, 300):
+            await asyncio.sleep(delay)
+            if any(await asyncio.gather(*(_check_and_notify_youtube(playlist) for playlist in playlists))):
+                break
+    except Exception:
+        logger.exception('Failed to process youtube websub notification for channel %s.', channel_id)
+
+
+async def _check_and_notify_youtube(playlist_id: str) -> bool:
+    """Checks a playlist for new videos and notifies every guild (of any bot) following it. Returns if any were new."""
+    async with _PLAYLIST_LOCKS[playlist_id]:
+        targets = {app: playlist_guilds[playlist_id] for app, playlist_guilds in _NOTIFY_PLAYLIST_GUILDS.items()
+                   if playlist_id in playlist_guilds}
+        logger.info('Checking new youtube videos for guilds %s, playlist %s', list(targets.values()), playlist_id)
+        await _PLAYLIST_STATES.load()
+        state = PlaylistState(**_PLAYLIST_STATES[playlist_id]) if playlist_id in _PLAYLIST_STATES else None
+        new_videos, new_state = await youtube.get_new_playlist_videos(playlist_id, state)
+        _PLAYLIST_STATES[playlist_id] = asdict(new_state)
+        if state is None:
+            # First load of playlist; keep for later reference
+            logger.info('Initial load: %d recent videos in playlist %s', len(new_state.recent_item_ids), playlist_id)
+            return False
+        elif not new_videos:
+            return False
+    # There are new videos to notify
+    logger.info('Found new youtube videos %s in playlist %s, sending notifications...', new_videos, playlist_id)
+
+    for video_channel, video_id in await youtube.get_playlist_video_details(new_videos):
+        for app, guilds in targets.items():
             for guild in guilds:
                 channel_id = await values.youtube_notif_channel_id.get_value(guild)
                 channel = app.cache.get_guild_channel(channel_id)
@@ -100,6 +328,7 @@ async def _check_and_notify_youtube(playlist_id: str, guilds: set[int], app: lig
                 else:
                     logger.error('Did not send a youtube notification for guild %s channel %s: invalid channel ID',
                                  guild, channel)
+    return True
 
 
 @plugin.periodic_task(timedelta(minutes=10))
@@ -112,12 +341,20 @@ async def youtube_notif(app: lightbulb.BotApp):
                 playlists = await values.youtube_notif_playlist_ids.get_value(guild) or []
                 for playlist in playlists:
                     playlist_guilds[playlist].add(guild)
+        _NOTIFY_PLAYLIST_GUILDS[app] = playlist_guilds
 
         try:
+            if youtube_websub is not None:
+                # Uploads are pushed by websub as they happen. Polling is only a fallback for missed pushes.
+                all_playlists = set().union(*_NOTIFY_PLAYLIST_GUILDS.values())
+                for playlist in all_playlists - _PLAYLIST_CHANNELS.keys():
+                    _PLAYLIST_CHANNELS[playlist] = await youtube.get_playlist_channel_id(playlist)
+                await youtube_websub.sync({channel for p in all_playlists if (channel := _PLAYLIST_CHANNELS[p])})
+                if datetime.now() - _LAST_POLLED.get(app, datetime.min) < _WEBSUB_POLL_INTERVAL:
+                    return
+            _LAST_POLLED[app] = datetime.now()
             # Check which accounts had a new post
-            await asyncio.gather(*(
-                _check_and_notify_youtube(playlist, guilds, app=app) for playlist, guilds in playlist_guilds.items()
-            ))
+            await asyncio.gather(*(_check_and_notify_youtube(playlist) for playlist in playlist_guilds))
         except Exception:
             logger.exception('Failed to process youtube notifications.')
 
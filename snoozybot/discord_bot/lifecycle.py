@@ -1,41 +1,101 @@
 import asyncio
+import cProfile
+import functools
+import importlib
+import io
 import logging
 import math
+import pkgutil
+import pstats
+import time
+from dataclasses import dataclass
 
 import hikari
 import lightbulb
+from hikari.api import CacheComponents
 from hikari.impl.config import CacheSettings
 from pydantic import SecretStr
 
+from snoozybot.config import values
 from snoozybot.config.env import envConfig
-from snoozybot.config.provider import get_secret_configs
+from snoozybot.config.provider import ConfigValue, get_secret_configs
 from snoozybot.exceptions import UserError
+from snoozybot.utils import LightbulbPlugin
 
 logger = logging.getLogger(__name__)
 
 _bots: list[lightbulb.BotApp] = []
 
-bot_intents = (
-    hikari.Intents.GUILDS
-    | hikari.Intents.GUILD_MESSAGES
-    | hikari.Intents.MESSAGE_CONTENT
-    | hikari.Intents.GUILD_MEMBERS
-    | hikari.Intents.GUILD_MODERATION
-    | hikari.Intents.GUILD_PRESENCES
+_EXTENSIONS_PACKAGE = 'snoozybot.discord_bot.commands'
+# Intents and cache components every bot needs; plugins add their own on top of these
+_BASE_INTENTS = hikari.Intents.GUILDS | hikari.Intents.GUILD_MEMBERS
+_BASE_CACHE_COMPONENTS = (
+    CacheComponents.GUILDS
+    | CacheComponents.GUILD_CHANNELS
+    | CacheComponents.GUILD_THREADS
+    | CacheComponents.ROLES
+    | CacheComponents.MEMBERS
+    | CacheComponents.ME
+    | CacheComponents.DM_CHANNEL_IDS
 )
-cache_settings = CacheSettings(max_messages=3000)
 
 
-def create_bot(token: SecretStr, guilds: set[int]) -> lightbulb.BotApp:
+@functools.cache
+def _get_extension_plugins() -> dict[str, LightbulbPlugin]:
+    """Import all extensions. This happens once, and the extensions are then loaded from these modules into each bot."""
+    plugins: dict[str, LightbulbPlugin] = {}
+    import_times: dict[str, float] = {}
+    for module_info in pkgutil.iter_modules([_EXTENSIONS_PACKAGE.replace('.', '/')]):
+        extension = f'{_EXTENSIONS_PACKAGE}.{module_info.name}'
+        started = time.perf_counter()
+        plugins[extension] = importlib.import_module(extension).plugin
+        import_times[module_info.name] = time.perf_counter() - started
+    slowest = sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:5]
+    logger.info('Imported %d extensions in %.2fs, slowest: %s', len(plugins), sum(import_times.values()),
+                ', '.join(f'{name} {seconds:.2f}s' for name, seconds in slowest))
+    return plugins
+
+
+async def _get_enabled_extensions(guilds: set[int]) -> tuple[list[str], hikari.Intents]:
+    """Find the extensions used by any of the guilds, and the gateway intents they need."""
+    extensions: list[str] = []
+    intents = _BASE_INTENTS
+    for extension, plugin in _get_extension_plugins().items():
+        if await plugin.is_enabled(guilds):
+            extensions.append(extension)
+            intents |= plugin.intents
+        else:
+            logger.info('Not loading %s for guilds %s: not enabled in any guild', plugin.name, guilds)
+    return extensions, intents
+
+
+async def create_bot(token: SecretStr, guilds: set[int]) -> lightbulb.BotApp:
+    extensions, intents = await _get_enabled_extensions(guilds)
+    cache_components = _BASE_CACHE_COMPONENTS
+    if intents & hikari.Intents.GUILD_MESSAGES:
+        cache_components |= CacheComponents.MESSAGES
+    if intents & hikari.Intents.GUILD_PRESENCES:
+        cache_components |= CacheComponents.PRESENCES
     bot = lightbulb.BotApp(
         token=token.get_secret_value(),
         logs=envConfig.log_level,
         banner=None,
-        intents=bot_intents,
-        cache_settings=cache_settings,
+        intents=intents,
+        cache_settings=CacheSettings(components=cache_components, max_messages=3000),
+        auto_chunk_members=False,  # see on_guild_available
     )
     bot.default_enabled_guilds = guilds
-    bot.load_extensions_from('snoozybot/discord_bot/commands')
+    bot.load_extensions(*extensions)
+
+    @bot.listen()
+    async def on_guild_available(event: hikari.GuildAvailableEvent) -> None:
+        # Every new gateway session (i.e. every restart) receives all guilds again. Large guilds only include online
+        # members, so the rest of the members are requested. Unlike hikari's automatic chunking, this skips guilds we
+        # don't own, and doesn't request presences again: they were all sent with the guild already.
+        if event.guild_id in bot.default_enabled_guilds and (
+            event.guild.is_large or not intents & hikari.Intents.GUILD_PRESENCES
+        ):
+            await event.shard.request_guild_members(event.guild_id, include_presences=False)
 
     @bot.listen()
     async def on_error(event: lightbulb.CommandErrorEvent) -> None:
@@ -78,18 +138,27 @@ def create_bot(token: SecretStr, guilds: set[int]) -> lightbulb.BotApp:
     return bot
 
 
-async def _start_bot(b: lightbulb.BotApp):
+@dataclass(frozen=True)
+class BotPartition:
+    """The part of a token's bot run by one process: its guilds, and when sharded, the shards these guilds are on."""
+    guilds: frozenset[int]
+    shard_count: int | None = None
+    shard_ids: tuple[int, ...] | None = None
+
+
+def get_shard_id(guild_id: int, shard_count: int) -> int:
+    return (guild_id >> 22) % shard_count
+
+
+async def _start_bot(b: lightbulb.BotApp, partition: BotPartition):
     try:
-        return await b.start(check_for_updates=False)
+        return await b.start(check_for_updates=False, shard_count=partition.shard_count, shard_ids=partition.shard_ids)
     except RuntimeError:
         logger.exception(f'FAILED TO START BOT FOR GUILDS {b.default_enabled_guilds}')
         raise
 
 
-async def start() -> None:
-    global _bots
-    logger.info('Starting discord bots...')
-
+async def get_guild_groups() -> dict[SecretStr, set[int]]:
     # Get tokens from config store
     tokens_config = await get_secret_configs('secret.discord.token')
 
@@ -97,18 +166,92 @@ async def start() -> None:
     grouped: dict[SecretStr, set[int]] = {}
     for guild_id, token in tokens_config.items():
         grouped.setdefault(token, set()).add(guild_id)
+    return grouped
+
+
+async def get_bot_partitions(split_shards: bool = False) -> list[tuple[SecretStr, BotPartition]]:
+    """
+    Work out the bots to run. Sharded tokens run all of their shards in one bot, unless split_shards is set, where they
+    are split into groups of discord.shards_per_worker. Only shards that have any of our guilds on them are run.
+    """
+    partitions: list[tuple[SecretStr, BotPartition]] = []
+    for token, guilds in (await get_guild_groups()).items():
+        shard_count = await _get_token_config(values.discord_shard_count, guilds)
+        if not shard_count:
+            partitions.append((token, BotPartition(frozenset(guilds))))
+            continue
+        shards_per_partition = shard_count
+        if split_shards:
+            shards_per_partition = await _get_token_config(values.discord_shards_per_worker, guilds) or shard_count
+        for first_shard in range(0, shard_count, shards_per_partition):
+            shard_range = range(first_shard, min(first_shard + shards_per_partition, shard_count))
+            partition_guilds = frozenset(guild for guild in guilds if get_shard_id(guild, shard_count) in shard_range)
+            if partition_guilds:
+                # Skip the shards without any of our guilds; these would only receive events we ignore
+                shard_ids = tuple(sorted({get_shard_id(guild, shard_count) for guild in partition_guilds}))
+                partitions.append((token, BotPartition(partition_guilds, shard_count, shard_ids)))
+    return partitions
+
+
+async def _get_token_config(config: ConfigValue[int], guilds: set[int]) -> int | None:
+    """Token-wide configs may be set on any guild of the token."""
+    for guild in sorted(guilds):
+        if value := await config.get_value(guild):
+            return value
+    return None
+
+
+async def start(only_partition: BotPartition | None = None) -> None:
+    """Start the bots for all guilds, or when running as a worker, only the bot for the given partition."""
+    global _bots
+    logger.info('Starting discord bots...')
+    started = time.perf_counter()
+    profiler = cProfile.Profile() if envConfig.profile_startup else None
+    if profiler:
+        profiler.enable()
 
     # Prepare one bot for each group
-    for token, guilds in grouped.items():
-        logger.info(f'Creating discord bot for guilds {guilds}')
-        bot = create_bot(token, guilds)
+    partitions: list[BotPartition] = []
+    for token, partition in await get_bot_partitions(split_shards=only_partition is not None):
+        if only_partition is not None and partition != only_partition:
+            continue
+        logger.info(f'Creating discord bot for guilds {set(partition.guilds)}, shards {partition.shard_ids}')
+        bot = await create_bot(token, set(partition.guilds))
         _bots.append(bot)
+        partitions.append(partition)
+    if only_partition is not None and not _bots:
+        logger.warning('Bot configuration changed since this worker was started. Not starting any bots.')
+    created = time.perf_counter()
 
-    await asyncio.gather(*(_start_bot(bot) for bot in _bots))
+    await asyncio.gather(*(_start_bot(bot, partition) for bot, partition in zip(_bots, partitions)))
+    logger.info('Started %d discord bots in %.2fs: %.2fs creating bots, %.2fs connecting to the gateway', len(_bots),
+                time.perf_counter() - started, created - started, time.perf_counter() - created)
+    if profiler:
+        profiler.disable()
+        _log_profile(profiler)
     await asyncio.gather(*(bot.join() for bot in _bots))
 
 
+def _log_profile(profiler: cProfile.Profile) -> None:
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(40)
+    logger.info('Startup profile:\n%s', report.getvalue())
+
+
 async def stop():
     global _bots
     logger.info('Closing connections on all discord bots...')
     await asyncio.gather(*(bot.close() for bot in _bots))
+
+
+def health() -> list[dict]:
+    """Status of each running bot, as reported by workers to the supervisor."""
+    return [
+        {
+            'guilds': sorted(bot.default_enabled_guilds),
+            'shards': sorted(bot.shards),
+            'alive': bot.is_alive,
+            'latency': bot.heartbeat_latency,
+        }
+        for bot in _bots
+    ]
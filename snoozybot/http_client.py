@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import random
+import time
+import typing
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import aiohttp
+import yarl
+
+logger = logging.getLogger(__name__)
+
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_RETRY_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+_DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10, sock_read=30)
+
+
+@dataclass
+class HostStats:
+    """Request counts and latencies to a single host."""
+    requests: int = 0
+    errors: int = 0
+    retries: int = 0
+    total_seconds: float = 0
+    max_seconds: float = 0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.requests if self.requests else 0
+
+    def __str__(self) -> str:
+        return (f'{self.requests} requests, {self.errors} errors, {self.retries} retries, '
+                f'mean {self.mean_seconds * 1000:.0f}ms, max {self.max_seconds * 1000:.0f}ms')
+
+
+class HttpClient:
+    """
+    The HTTP client for all outbound integrations. Requests share one connection pool with per-host limits, DNS
+    caching and default timeouts, and their counts and latencies are recorded per host.
+    GET requests made through `get` are retried with backoff on connection errors and retryable statuses.
+    """
+
+    def __init__(
+        self,
+        *,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        dns_cache_seconds: int = 300,
+        timeout: aiohttp.ClientTimeout = _DEFAULT_TIMEOUT,
+        retries: int = 3,
+        backoff_seconds: float = 0.5,
+        max_backoff_seconds: float = 10,
+    ) -> None:
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._dns_cache_seconds = dns_cache_seconds
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._session: aiohttp.ClientSession | None = None
+        self.stats: defaultdict[str, HostStats] = defaultdict(HostStats)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The underlying session, created on first use since it must be created inside the running event loop."""
+        if self._session is None or self._session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_request_start)
+            trace_config.on_request_end.append(self._on_request_end)
+            trace_config.on_request_exception.append(self._on_request_exception)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._limit, limit_per_host=self._limit_per_host, ttl_dns_cache=self._dns_cache_seconds,
+                ),
+                timeout=self._timeout,
+                trace_configs=[trace_config],
+            )
+        return self._session
+
+    @asynccontextmanager
+    async def get(self, url: str, *, retries: int | None = None,
+                  **kwargs: typing.Any) -> typing.AsyncIterator[aiohttp.ClientResponse]:
+        """Makes a GET request, retrying on connection errors and retryable statuses. Use as a context manager."""
+        retries = self._retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                resp = await self.session.get(url, **kwargs)
+            except _RETRY_ERRORS:
+                if attempt == retries:
+                    raise
+            else:
+                if resp.status not in _RETRY_STATUSES or attempt == retries:
+                    break
+                resp.release()
+            self.stats[_host(url)].retries += 1
+            await asyncio.sleep(self._get_backoff(attempt))
+        async with resp:
+            yield resp
+
+    def post(self, url: str, **kwargs: typing.Any) -> typing.AsyncContextManager[aiohttp.ClientResponse]:
+        """Makes a POST request. These are not retried since they may not be idempotent."""
+        return self.session.post(url, **kwargs)
+
+    def ws_connect(self, url: str, **kwargs: typing.Any) -> typing.AsyncContextManager[aiohttp.ClientWebSocketResponse]:
+        return self.session.ws_connect(url, **kwargs)
+
+    def log_stats(self) -> None:
+        for host, stats in sorted(self.stats.items()):
+            logger.info('HTTP %s: %s', host, stats)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self.log_stats()
+
+    def _get_backoff(self, attempt: int) -> float:
+        # Full jitter, so that clients failing together do not retry together
+        return random.uniform(0, min(self._max_backoff_seconds, self._backoff_seconds * 2 ** attempt))
+
+    async def _on_request_start(self, _: aiohttp.ClientSession, context: SimpleNamespace,
+                                params: aiohttp.TraceRequestStartParams) -> None:
+        context.start = time.monotonic()
+
+    async def _on_request_end(self, _: aiohttp.ClientSession, context: SimpleNamespace,
+                              params: aiohttp.TraceRequestEndParams) -> None:
+        self._record(params.url.host, context, error=params.response.status >= 400)
+
+    async def _on_request_exception(self, _: aiohttp.ClientSession, context: SimpleNamespace,
+                                    params: aiohttp.TraceRequestExceptionParams) -> None:
+        self._record(params.url.host, context, error=True)
+
+    def _record(self, host: str | None, context: SimpleNamespace, error: bool) -> None:
+        elapsed = time.monotonic() - context.start
+        stats = self.stats[host or '']
+        stats.requests += 1
+        stats.errors += error
+        stats.total_seconds += elapsed
+        stats.max_seconds = max(stats.max_seconds, elapsed)
+
+
+def _host(url: str) -> str:
+    return yarl.URL(url).host or ''
+
+
+http_client = HttpClient()
@@ -0,0 +1,240 @@
+"""
+Supervisor mode: runs the bot of each group of guilds (i.e. each discord token, or each group of shards of a sharded
+token) in its own worker process, so that busy bots don't starve the others of CPU. Workers share the database.
+The supervisor restarts workers that crash or stop reporting health, and drains all workers gracefully on shutdown.
+It also re-reads the bot configuration periodically and whenever a worker exits cleanly, starting and stopping workers
+as tokens and shards are added or removed. Only supported on POSIX systems.
+"""
+import asyncio
+import logging
+import math
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.process
+import signal
+import time
+import typing
+from dataclasses import dataclass, field
+
+import snoozybot.database.lifecycle as database
+import snoozybot.discord_bot.lifecycle as discord_bot
+from snoozybot.config.env import envConfig
+
+logger = logging.getLogger(__name__)
+
+_HEALTH_REPORT_INTERVAL = 30  # seconds
+_HEALTH_TIMEOUT = 300  # restart workers that haven't reported health for this long
+_HEALTH_LOG_INTERVAL = 600
+_DRAIN_TIMEOUT = 30
+_MAX_RESTART_DELAY = 300
+_STABLE_AFTER = 600  # workers that ran this long are restarted without delay
+_PARTITION_CHECK_INTERVAL = 600
+
+# Called with the partition to run, whether this is the primary worker, and the connection to report health on
+WorkerTarget = typing.Callable[[discord_bot.BotPartition, bool, multiprocessing.connection.Connection], None]
+
+
+@dataclass
+class Worker:
+    partition: discord_bot.BotPartition
+    primary: bool
+    process: multiprocessing.process.BaseProcess | None = None
+    conn: multiprocessing.connection.Connection | None = None
+    started_at: float = 0
+    last_report: float = 0
+    restarts: int = 0
+    failures: int = 0  # consecutive crashes, for restart backoff
+    restart_at: float = 0
+    health: list[dict] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        shards = f', shards {self.partition.shard_ids}' if self.partition.shard_ids else ''
+        return f'worker {self.process.pid if self.process else "-"} (guilds {sorted(self.partition.guilds)}{shards})'
+
+
+def supervise(target: WorkerTarget) -> None:
+    """
+    Start a worker process for each bot partition and keep them running. The first worker is the primary one, which
+    runs the components that can only run once, like webhook receivers.
+    """
+    if not logging.getLogger().handlers:
+        # Bots set up logging when they're created, but the supervisor doesn't create any
+        logging.basicConfig(level=envConfig.log_level)
+    context = multiprocessing.get_context('spawn')
+    workers = _sync_workers([], asyncio.run(_get_bot_partitions()))
+    stopping = False
+
+    def request_stop(signum: int, _: typing.Any) -> None:
+        nonlocal stopping
+        logger.info('Received signal %s, draining workers...', signal.Signals(signum).name)
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    logger.info('Starting %d workers', len(workers))
+    last_health_log = time.monotonic()
+    next_partition_check = last_health_log + _PARTITION_CHECK_INTERVAL
+    while not stopping:
+        now = time.monotonic()
+        if now >= next_partition_check:
+            try:
+                workers = _sync_workers(workers, asyncio.run(_get_bot_partitions()))
+            except Exception:
+                logger.exception('Failed to read the bot configuration, keeping the current workers')
+            next_partition_check = now + _PARTITION_CHECK_INTERVAL
+        for worker in workers:
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    _start_worker(context, worker, target)
+                continue
+            _receive_reports(worker, now)
+            if not worker.process.is_alive() and worker.process.exitcode == 0:
+                # Workers only exit by themselves when their bot configuration changed. Only restart them if their
+                # partition still exists.
+                logger.info('%s exited, checking the bot configuration', worker)
+                _close_process(worker)
+                worker.restart_at = math.inf
+                next_partition_check = now
+            elif not worker.process.is_alive():
+                _schedule_restart(worker, now)
+            elif now - worker.last_report > _HEALTH_TIMEOUT:
+                logger.error('%s has not reported health in %d seconds, killing it', worker, now - worker.last_report)
+                worker.process.kill()
+        if now - last_health_log > _HEALTH_LOG_INTERVAL:
+            _log_health(workers, now)
+            last_health_log = now
+        waitables = [w.process.sentinel for w in workers if w.process] + [w.conn for w in workers if w.conn]
+        multiprocessing.connection.wait(waitables, timeout=5)
+    _drain(workers)
+
+
+def run_worker(main: typing.Coroutine) -> None:
+    """
+    Runs the main coroutine of a worker process. SIGTERM from the supervisor cancels it, so that it can clean up and
+    exit. SIGINT is ignored, since the supervisor also receives it and will stop the workers.
+    """
+
+    async def run() -> None:
+        loop = asyncio.get_running_loop()
+        task = asyncio.create_task(main)
+
+        def stop() -> None:
+            loop.remove_signal_handler(signal.SIGTERM)  # don't interrupt the cleanup
+            task.cancel()
+
+        loop.add_signal_handler(signal.SIGTERM, stop)
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info('Worker stopped.')
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run())
+
+
+async def report_health(conn: multiprocessing.connection.Connection) -> None:
+    """Periodically sends the health of this worker's bots to the supervisor."""
+    while True:
+        conn.send(discord_bot.health())
+        await asyncio.sleep(_HEALTH_REPORT_INTERVAL)
+
+
+async def _get_bot_partitions() -> list[discord_bot.BotPartition]:
+    await database.start()
+    try:
+        return [partition for _, partition in await discord_bot.get_bot_partitions(split_shards=True)]
+    finally:
+        await database.stop()
+
+
+def _start_worker(context: multiprocessing.context.SpawnContext, worker: Worker, target: WorkerTarget) -> None:
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=target, args=(worker.partition, worker.primary, sender),
+                              name=f'bot-{min(worker.partition.guilds)}')
+    process.start()
+    worker.process = process
+    sender.close()  # only the worker writes to it
+    worker.conn = receiver
+    worker.started_at = worker.last_report = time.monotonic()
+    worker.health = []
+    logger.info('Started %s', worker)
+
+
+def _receive_reports(worker: Worker, now: float) -> None:
+    try:
+        while worker.conn and worker.conn.poll():
+            worker.health = worker.conn.recv()
+            worker.last_report = now
+    except (EOFError, OSError):
+        pass  # worker exited; handled by the caller
+
+
+def _sync_workers(workers: list[Worker], partitions: list[discord_bot.BotPartition]) -> list[Worker]:
+    """Stops the workers of partitions that no longer exist, and adds workers for new partitions."""
+    removed = [worker for worker in workers if worker.partition not in partitions]
+    for worker in removed:
+        logger.info('%s is no longer configured, stopping it', worker)
+    _stop_workers(removed)
+    for worker in removed:
+        _close_process(worker)
+    workers = [worker for worker in workers if worker.partition in partitions]
+    for worker in workers:
+        if worker.restart_at == math.inf:
+            worker.restart_at = 0  # exited by itself, but its partition is still configured
+    existing = {worker.partition for worker in workers}
+    workers += [Worker(partition=partition, primary=False) for partition in partitions if partition not in existing]
+    if workers and not any(worker.primary for worker in workers):
+        primary = workers[0]
+        primary.primary = True
+        if primary.process is not None:
+            logger.info('%s becomes the primary worker, restarting it', primary)
+            primary.process.terminate()  # exits cleanly, and is restarted since its partition still exists
+    return workers
+
+
+def _close_process(worker: Worker) -> None:
+    if worker.conn:
+        worker.conn.close()
+    if worker.process:
+        worker.process.close()
+    worker.process = worker.conn = None
+
+
+def _schedule_restart(worker: Worker, now: float) -> None:
+    exit_code = worker.process.exitcode if worker.process else None
+    if now - worker.started_at > _STABLE_AFTER:
+        worker.failures = 0
+    delay = min(_MAX_RESTART_DELAY, 2 ** worker.failures - 1)
+    logger.error('%s exited with code %s, restarting in %d seconds', worker, exit_code, delay)
+    _close_process(worker)
+    worker.failures += 1
+    worker.restarts += 1
+    worker.restart_at = now + delay
+
+
+def _log_health(workers: list[Worker], now: float) -> None:
+    for worker in workers:
+        if worker.process is None:
+            logger.info('%s: not running, %d restarts', worker, worker.restarts)
+            continue
+        bots = ', '.join(f'{"up" if bot["alive"] else "down"} {bot["latency"] * 1000:.0f}ms' for bot in worker.health)
+        logger.info('%s: running for %ds, %d restarts, last report %ds ago, bots: %s', worker,
+                    now - worker.started_at, worker.restarts, now - worker.last_report, bots or 'starting')
+
+
+def _drain(workers: list[Worker]) -> None:
+    _stop_workers(workers)
+    logger.info('All workers stopped.')
+
+
+def _stop_workers(workers: list[Worker]) -> None:
+    running = [(worker, worker.process) for worker in workers if worker.process and worker.process.is_alive()]
+    for _, process in running:
+        process.terminate()
+    deadline = time.monotonic() + _DRAIN_TIMEOUT
+    for worker, process in running:
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            logger.warning('%s did not stop in time, killing it', worker)
+            process.kill()
+            process.join()
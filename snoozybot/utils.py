@@ -1,20 +1,22 @@
 import asyncio
 import datetime
+import functools
 import logging
 import typing
-from copy import deepcopy
+from copy import copy
 from typing import Hashable
 
-import aiohttp
 import hikari
 import lightbulb
 import lightbulb.ext.tasks
 
 from snoozybot.config import values
+from snoozybot.config.provider import ConfigValue
 
 log = logging.getLogger(__name__)
 _LightbulbExtensionHook = typing.Callable[[lightbulb.BotApp], None]
 _TaskFunc = typing.Callable[[lightbulb.BotApp], typing.Awaitable]
+_ListenerT = typing.Callable[[hikari.Event], typing.Coroutine[typing.Any, typing.Any, None]]
 
 
 class UserGuildBucket(lightbulb.Bucket):
@@ -52,22 +54,77 @@ async def mention_if_needed(ctx: lightbulb.ApplicationContext, member: hikari.Me
         return member.mention
 
 
+def _own_guild_events_only(listener_func: _ListenerT) -> _ListenerT:
+    @functools.wraps(listener_func)
+    async def listener(event: hikari.Event) -> None:
+        guild_id = getattr(event, 'guild_id', None)
+        if guild_id is None or guild_id in event.app.default_enabled_guilds:
+            await listener_func(event)
+
+    return listener
+
+
 class LightbulbPlugin(lightbulb.Plugin):
-    """Extension of lightbulb plugin where we ignore commands that do not belong in a bot."""
-    __slots__ = ['_periodic_tasks', '_raw_commands']
+    """
+    Extension of lightbulb plugin where we ignore commands that do not belong in a bot.
 
-    def __init__(self, name: str):
+    A plugin may declare the gateway intents it needs, and configs that enable it. A plugin with `enabled_by` configs
+    is only loaded into a bot if any of that bot's guilds has one of them set.
+    """
+    __slots__ = ['_periodic_tasks', '_raw_commands', 'intents', '_enabled_by']
+
+    def __init__(self, name: str, *, intents: hikari.Intents = hikari.Intents.NONE,
+                 enabled_by: typing.Sequence[ConfigValue] = ()):
         super().__init__(name=name)
         self._periodic_tasks: list[_TaskFunc] = []
+        self.intents = intents
+        self._enabled_by = enabled_by
+
+    async def is_enabled(self, guilds: typing.Iterable[int]) -> bool:
+        if not self._enabled_by:
+            return True
+        for guild in guilds:
+            for config in self._enabled_by:
+                if await config.get_value(guild):
+                    return True
+        return False
+
+    def listener(self, event: type[hikari.Event], listener_func: _ListenerT | None = None, *, bind: bool = False):
+        """
+        Same as lightbulb's listener, except that events from guilds that are not one of the bot's own guilds are
+        dropped before calling the listener. A guild may have several of our bots in it, but only the one configured
+        for the guild should process its events.
+        """
+        if listener_func is None:
+            return super().listener(event, bind=bind)
+        callback: _ListenerT = listener_func.__get__(self) if bind else listener_func
+        super().listener(event, _own_guild_events_only(callback))
+        return callback
 
     def create_commands(self) -> None:
+        # The raw commands are shared by all bots, so guild-specific commands are copied before limiting their guilds
         self._raw_commands: list[lightbulb.CommandLike]
+        raw_commands: list[lightbulb.CommandLike] = []
         for command in self._raw_commands:
             if command.guilds:
+                command = copy(command)
                 command.guilds = set(command.guilds) & set(self.app.default_enabled_guilds)
-        self._raw_commands = [command for command in self._raw_commands if command.guilds != set()]
+                if not command.guilds:
+                    continue
+            raw_commands.append(command)
+        self._raw_commands = raw_commands
         super().create_commands()
 
+    def _copy_for_bot(self) -> 'LightbulbPlugin':
+        """
+        A copy of this plugin to add to a bot. Only the commands created when the copy is added are specific to the
+        bot; the raw commands, listeners and tasks are shared with the other bots.
+        """
+        plugin = copy(self)
+        plugin._all_commands = []
+        plugin._app = None
+        return plugin
+
     def export_extension(self) -> tuple[_LightbulbExtensionHook, _LightbulbExtensionHook]:
         """Shorthand to help create the load and unload methods for an extension.
 
@@ -75,7 +132,7 @@ class LightbulbPlugin(lightbulb.Plugin):
         """
 
         def load(bot: lightbulb.BotApp):
-            bot.add_plugin(deepcopy(self))
+            bot.add_plugin(self._copy_for_bot())
             for task in self._periodic_tasks:
                 bot.subscribe(hikari.events.StartedEvent, self._register_task(task, bot))
 
@@ -108,13 +165,3 @@ class LightbulbPlugin(lightbulb.Plugin):
             return bot.create_task(task(bot))
 
         return _start
-
-
-client_session: aiohttp.ClientSession = None
-
-
-def get_client_session():
-    global client_session
-    if not client_session:
-        client_session = aiohttp.ClientSession()
-    return client_session
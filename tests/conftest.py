@@ -0,0 +1,22 @@
+import asyncio
+import os
+import typing
+
+import pytest
+
+# The environment config is read on import, and these tests don't need a database
+os.environ.setdefault('DATABASE_URL', 'postgres://localhost/snoozybot_test')
+
+
+@pytest.fixture
+def run() -> typing.Callable[[typing.Awaitable], typing.Any]:
+    """Runs a coroutine in a new event loop, closing the shared HTTP client's session in that loop afterwards."""
+    from snoozybot.http_client import http_client
+
+    async def run_and_close(coroutine: typing.Awaitable) -> typing.Any:
+        try:
+            return await asyncio.wait_for(coroutine, timeout=30)
+        finally:
+            await http_client.close()
+
+    return lambda coroutine: asyncio.run(run_and_close(coroutine))
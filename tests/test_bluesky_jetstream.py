@@ -0,0 +1,188 @@
+import asyncio
+import contextlib
+import json
+import types
+import typing
+
+from aiohttp import test_utils, web
+
+from snoozybot.discord_bot.commands import bluesky
+from snoozybot.discord_bot.commands.bluesky import JetstreamConsumer
+
+ALICE = 'did:plc:alice'
+BOB = 'did:plc:bob'
+
+
+def _post(did: str, rkey: str, time_us: int, **record: typing.Any) -> dict:
+    return {'did': did, 'time_us': time_us, 'kind': 'commit', 'commit': {
+        'operation': 'create', 'collection': 'app.bsky.feed.post', 'rkey': rkey,
+        'record': {'text': rkey, 'createdAt': '2026-10-19T10:00:00Z', **record},
+    }}
+
+
+class FakeJetstream:
+    """
+    A jetstream server over a fixed log of events. Like the real one, it replays events from the cursor if one is
+    given, and only sends the events of the wanted DIDs.
+    """
+
+    def __init__(self, events: list[dict]) -> None:
+        self.events = events
+        self.connections: list[dict[str, list[str]]] = []  # the query parameters of each connection
+        self.close_after_replay = 0  # number of upcoming connections to close once the log was sent
+        self._server: test_utils.TestServer | None = None
+
+    async def __aenter__(self) -> 'FakeJetstream':
+        app = web.Application()
+        app.router.add_get('/subscribe', self._subscribe)
+        self._server = test_utils.TestServer(app)
+        await self._server.start_server()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        if self._server:
+            await self._server.close()
+
+    @property
+    def url(self) -> str:
+        assert self._server
+        return str(self._server.make_url('/subscribe'))
+
+    async def _subscribe(self, request: web.Request) -> web.WebSocketResponse:
+        params = {key: request.query.getall(key) for key in request.query.keys()}
+        self.connections.append(params)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        cursor = int(params.get('cursor', ['0'])[0])
+        for event in self.events:
+            if event['time_us'] >= cursor and event['did'] in params.get('wantedDids', []):
+                await ws.send_str(json.dumps(event))
+        if self.close_after_replay:
+            self.close_after_replay -= 1
+            await ws.close()
+        else:
+            await ws.receive()  # until the client disconnects
+        return ws
+
+
+class Consumer:
+    """Runs a jetstream consumer in the background, recording the posts it receives."""
+
+    def __init__(self, url: str, dids: set[str]) -> None:
+        self.posts: list[tuple[str, str]] = []
+        self.consumer = JetstreamConsumer(url, self._on_post)
+        self.consumer.set_dids(dids)
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> 'Consumer':
+        self._task = asyncio.create_task(self.consumer.run())
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        assert self._task
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    async def _on_post(self, did: str, rkey: str, record: dict) -> None:
+        self.posts.append((did, rkey))
+
+
+async def _wait_until(condition: typing.Callable[[], bool]) -> None:
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError('Timed out waiting for condition')
+
+
+def test_reconnects_from_the_rewound_cursor_without_repeating_posts(run):
+    async def test():
+        async with FakeJetstream([_post(ALICE, '1', 10_000_000), _post(ALICE, '2', 20_000_000)]) as server:
+            server.close_after_replay = 1
+            async with Consumer(server.url, {ALICE}) as consumer:
+                await _wait_until(lambda: consumer.posts == [(ALICE, '1'), (ALICE, '2')])
+                # Posted while disconnected
+                server.events.append(_post(ALICE, '3', 30_000_000))
+                await _wait_until(lambda: len(server.connections) == 2)
+                await _wait_until(lambda: len(consumer.posts) == 3)
+                await asyncio.sleep(0.1)
+        assert 'cursor' not in server.connections[0]
+        # Rewound 5 seconds before the last event seen, so the server sent post 2 again
+        assert server.connections[1]['cursor'] == ['15000000']
+        assert consumer.posts == [(ALICE, '1'), (ALICE, '2'), (ALICE, '3')]
+
+    run(test())
+
+
+def test_only_wanted_dids_are_requested(run):
+    async def test():
+        async with FakeJetstream([_post(ALICE, 'a', 10_000_000), _post(BOB, 'b', 20_000_000)]) as server:
+            async with Consumer(server.url, {ALICE}) as consumer:
+                await _wait_until(lambda: consumer.posts == [(ALICE, 'a')])
+                consumer.consumer.set_dids({ALICE, BOB})
+                await _wait_until(lambda: len(server.connections) == 2)
+                await _wait_until(lambda: (BOB, 'b') in consumer.posts)
+        assert server.connections[0]['wantedDids'] == [ALICE]
+        assert server.connections[0]['wantedCollections'] == ['app.bsky.feed.post']
+        assert sorted(server.connections[1]['wantedDids']) == [ALICE, BOB]
+        assert server.connections[1]['cursor'] == ['5000000']
+        assert consumer.posts == [(ALICE, 'a'), (BOB, 'b')]
+
+    run(test())
+
+
+def test_replies_and_other_operations_are_skipped(run):
+    delete = _post(ALICE, 'deleted', 20_000_000)
+    delete['commit']['operation'] = 'delete'
+    identity = {'did': ALICE, 'time_us': 30_000_000, 'kind': 'identity'}
+    events = [_post(ALICE, 'reply', 10_000_000, reply={}), delete, identity, _post(ALICE, 'post', 40_000_000)]
+
+    async def test():
+        async with FakeJetstream(events) as server:
+            async with Consumer(server.url, {ALICE}) as consumer:
+                await _wait_until(lambda: consumer.posts)
+                await asyncio.sleep(0.1)
+        assert consumer.posts == [(ALICE, 'post')]
+
+    run(test())
+
+
+def test_waits_for_dids_before_connecting(run):
+    async def test():
+        async with FakeJetstream([_post(ALICE, '1', 10_000_000)]) as server:
+            async with Consumer(server.url, set()) as consumer:
+                await asyncio.sleep(0.2)
+                assert not server.connections
+                consumer.consumer.set_dids({ALICE})
+                await _wait_until(lambda: consumer.posts == [(ALICE, '1')])
+
+    run(test())
+
+
+def test_posts_that_were_already_announced_are_skipped(run, monkeypatch):
+    app = object()
+    sent = []
+
+    async def get_profile(actor: str) -> types.SimpleNamespace:
+        return types.SimpleNamespace(handle='alice.test', display_name='Alice')
+
+    async def send_post_notif(guilds: set[int], _app, handle: str, display_name: str, post_id: str) -> None:
+        sent.append((guilds, post_id))
+
+    monkeypatch.setattr(bluesky, '_USER_DIDS', {'alice.test': ALICE})
+    monkeypatch.setattr(bluesky, '_NOTIFY_USER_GUILDS', {app: {'alice.test': {1}}})
+    monkeypatch.setattr(bluesky, '_LAST_KNOWN_POST_TIME', {'alice.test': '2026-10-19T10:00:00Z'})
+    monkeypatch.setattr(bluesky, '_get_profile', get_profile)
+    monkeypatch.setattr(bluesky, '_send_post_notif', send_post_notif)
+
+    async def test():
+        # Announced by the fallback poll, or replayed after resuming from the cursor
+        await bluesky._on_jetstream_post(ALICE, 'polled', {'createdAt': '2026-10-19T10:00:00Z'})
+        await bluesky._on_jetstream_post(ALICE, 'older', {'createdAt': '2026-10-19T09:00:00Z'})
+        await bluesky._on_jetstream_post(ALICE, 'new', {'createdAt': '2026-10-19T11:00:00Z'})
+        await bluesky._on_jetstream_post(ALICE, 'new', {'createdAt': '2026-10-19T11:00:00Z'})
+
+    run(test())
+    assert sent == [({1}, 'new')]
+    assert bluesky._LAST_KNOWN_POST_TIME == {'alice.test': '2026-10-19T11:00:00Z'}
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+import tortoise
+import tortoise.transactions
+from tortoise.utils import get_schema_sql
+
+from snoozybot.config.env import envConfig
+from snoozybot.database import replica
+from snoozybot.database.models import Tuch
+
+
+@pytest.fixture
+def databases(monkeypatch):
+    """A primary and a replica database that don't replicate, so it's visible where each read went."""
+    monkeypatch.setattr(replica, '_replica_usable', False)
+    monkeypatch.setattr(replica, '_primary', None)
+    monkeypatch.setattr(replica, '_last_writes', {})
+    monkeypatch.setattr(replica, '_LAG_CHECK_INTERVAL', 0.01)
+
+    async def start() -> None:
+        await tortoise.Tortoise.init(config={
+            'connections': {'default': 'sqlite://:memory:', replica.CONNECTION: 'sqlite://:memory:'},
+            'apps': {'models': {'models': ['snoozybot.database.models'], 'default_connection': 'default'}},
+            'routers': [replica.ReplicaRouter],
+        })
+        schema = get_schema_sql(tortoise.connections.get('default'), safe=False)
+        for name in ('default', replica.CONNECTION):
+            await tortoise.connections.get(name).execute_script(schema)
+        # On the primary only
+        await Tuch.create(guild_id=1, user_id=2, max_butts=3, total_butts=4, total_tuchs=5)
+
+    async def stop() -> None:
+        await tortoise.Tortoise.close_connections()
+
+    return start, stop
+
+
+async def _monitor_lag_until(usable: bool) -> None:
+    task = asyncio.create_task(replica.monitor_lag())
+    try:
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if replica._replica_usable == usable:
+                return
+        raise AssertionError('Timed out waiting for the replica to become ' + ('usable' if usable else 'unusable'))
+    finally:
+        task.cancel()
+
+
+def _set_lag(monkeypatch: pytest.MonkeyPatch, lag: float | Exception) -> None:
+    """Answers the replica's lag check, which is specific to postgres, with the given lag or error."""
+    connection = tortoise.connections.get(replica.CONNECTION)
+    execute_query = connection.execute_query
+
+    async def execute_lag_query(query: str, values: list | None = None) -> tuple[int, list]:
+        if 'pg_last_xact_replay_timestamp' not in query:
+            return await execute_query(query, values)
+        if isinstance(lag, Exception):
+            raise lag
+        return 1, [{'lag': lag}]
+
+    monkeypatch.setattr(connection, 'execute_query', execute_lag_query)
+
+
+def test_reads_go_to_the_replica_when_it_is_usable(run, monkeypatch, databases):
+    start, stop = databases
+
+    async def test():
+        await start()
+        try:
+            assert await Tuch.filter(guild_id=1).count() == 1  # replica not checked yet
+            _set_lag(monkeypatch, 0)
+            replica._last_writes.clear()  # as if the write was long ago
+            await _monitor_lag_until(usable=True)
+            assert await Tuch.filter(guild_id=1).count() == 0
+            rows = await replica.get_read_connection(Tuch).execute_query_dict('SELECT * FROM tuch')
+            assert rows == []
+            async with tortoise.transactions.in_transaction('default'):
+                assert await Tuch.filter(guild_id=1).count() == 1
+        finally:
+            await stop()
+
+    run(test())
+
+
+def test_reads_of_recently_written_models_go_to_the_primary(run, monkeypatch, databases):
+    start, stop = databases
+
+    async def test():
+        await start()
+        try:
+            _set_lag(monkeypatch, 0)
+            await _monitor_lag_until(usable=True)
+            assert await Tuch.filter(guild_id=1).count() == 1
+            rows = await replica.get_read_connection(Tuch).execute_query_dict('SELECT * FROM tuch')
+            assert len(rows) == 1
+        finally:
+            await stop()
+
+    run(test())
+
+
+@pytest.mark.parametrize('lag', [envConfig.db_replica_max_lag + 1, RuntimeError('replica is down')])
+def test_reads_fall_back_to_the_primary_while_the_replica_lags(run, monkeypatch, databases, lag):
+    start, stop = databases
+
+    async def test():
+        await start()
+        try:
+            _set_lag(monkeypatch, 0)
+            replica._last_writes.clear()
+            await _monitor_lag_until(usable=True)
+            _set_lag(monkeypatch, lag)
+            await _monitor_lag_until(usable=False)
+            assert await Tuch.filter(guild_id=1).count() == 1
+            rows = await replica.get_read_connection(Tuch).execute_query_dict('SELECT * FROM tuch')
+            assert len(rows) == 1
+        finally:
+            await stop()
+
+    run(test())
@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import types
+
+import pytest
+import twitchio
+from aiohttp import test_utils
+
+from snoozybot.discord_bot.commands import twitch
+
+SECRET = 'eventsub-secret'
+BROADCASTER_ID = 1234
+SUBSCRIPTION_ID = 'f1c2a387-161a-49f9-a165-0f21d7a4e1c4'
+
+
+def _message(message_type: str, payload: dict, message_id: str = 'message-1') -> tuple[str, dict[str, str]]:
+    """A webhook message the way twitch signs and sends it."""
+    body = json.dumps(payload)
+    timestamp = '2026-10-19T10:00:00.123456Z'
+    signature = hmac.new(SECRET.encode(), (message_id + timestamp + body).encode(), hashlib.sha256).hexdigest()
+    return body, {
+        'Twitch-Eventsub-Message-Id': message_id,
+        'Twitch-Eventsub-Message-Retry': '0',
+        'Twitch-Eventsub-Message-Type': message_type,
+        'Twitch-Eventsub-Message-Signature': 'sha256=' + signature,
+        'Twitch-Eventsub-Message-Timestamp': timestamp,
+        'Twitch-Eventsub-Subscription-Type': 'stream.online',
+        'Twitch-Eventsub-Subscription-Version': '1',
+        'Content-Type': 'application/json',
+    }
+
+
+def _subscription(status: str = 'enabled') -> dict:
+    return {
+        'id': SUBSCRIPTION_ID, 'status': status, 'type': 'stream.online', 'version': '1', 'cost': 1,
+        'condition': {'broadcaster_user_id': str(BROADCASTER_ID)},
+        'transport': {'method': 'webhook', 'callback': 'https://example.com/eventsub'},
+        'created_at': '2026-10-19T09:00:00.123456Z',
+    }
+
+
+def _stream_online(stream_type: str = 'live') -> dict:
+    return {'subscription': _subscription(), 'event': {
+        'id': '9001', 'broadcaster_user_id': str(BROADCASTER_ID), 'broadcaster_user_login': 'snoozy',
+        'broadcaster_user_name': 'Snoozy', 'type': stream_type, 'started_at': '2026-10-19T10:00:00.123456Z',
+    }}
+
+
+class FakeTwitch:
+    """Patches the twitch client and the bot, and records the notifications that would be sent."""
+
+    def __init__(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        self.monkeypatch = monkeypatch
+        self.stream = types.SimpleNamespace(id=9001, user=types.SimpleNamespace(id=BROADCASTER_ID, name='Snoozy'))
+        self.user = types.SimpleNamespace(id=BROADCASTER_ID, name='snoozy')
+        self.notifications: list[tuple[int, int]] = []
+        self.app = object()
+
+    async def __aenter__(self) -> test_utils.TestClient:
+        client = twitchio.Client.from_client_credentials('client-id', 'client-secret')
+        client.fetch_streams = self._fetch_streams
+        self.monkeypatch.setattr(twitch, 'twitch', client)
+        self.monkeypatch.setattr(twitch, '_LAST_KNOWN_STREAM_ID', {})
+        self.monkeypatch.setattr(twitch, '_NOTIFY_LOGIN_GUILDS', {self.app: {'snoozy': {1, 2}}})
+        self.monkeypatch.setattr(twitch, '_EVENTSUB_SUBSCRIPTIONS', {BROADCASTER_ID: SUBSCRIPTION_ID})
+        self.monkeypatch.setattr(twitch.twitch_metadata, 'get_users_by_id', self._get_users_by_id)
+        self.monkeypatch.setattr(twitch, '_process_stream_notif', self._process_stream_notif)
+        server = test_utils.TestServer(twitch._create_eventsub_client('https://example.com/eventsub', SECRET))
+        self._client = test_utils.TestClient(server)
+        await self._client.start_server()
+        return self._client
+
+    async def __aexit__(self, *_) -> None:
+        await self._client.close()
+
+    async def _fetch_streams(self, user_ids: list[int], type: str) -> list:
+        assert user_ids == [BROADCASTER_ID]
+        return [self.stream]
+
+    async def _get_users_by_id(self, ids: list[int]) -> dict:
+        return {BROADCASTER_ID: self.user}
+
+    async def _process_stream_notif(self, stream, user, guild: int, app) -> None:
+        assert stream is self.stream and user is self.user and app is self.app
+        self.notifications.append((stream.id, guild))
+
+
+async def _post(client: test_utils.TestClient, message_type: str, payload: dict, **kwargs) -> int:
+    body, headers = _message(message_type, payload, **kwargs)
+    async with client.post('/eventsub', data=body, headers=headers) as resp:
+        status = resp.status
+    for _ in range(10):
+        await asyncio.sleep(0)  # let the dispatched handlers run
+    return status
+
+
+def test_stream_online_notifies_every_guild_once(run, monkeypatch):
+    fake = FakeTwitch(monkeypatch)
+
+    async def test():
+        async with fake as client:
+            assert await _post(client, 'notification', _stream_online()) == 200
+            # A retried delivery of the same event is ignored
+            assert await _post(client, 'notification', _stream_online(), message_id='message-2') == 200
+        assert sorted(fake.notifications) == [(9001, 1), (9001, 2)]
+        assert twitch._LAST_KNOWN_STREAM_ID == {'snoozy': 9001}
+
+    run(test())
+
+
+def test_reruns_are_not_notified(run, monkeypatch):
+    fake = FakeTwitch(monkeypatch)
+
+    async def test():
+        async with fake as client:
+            assert await _post(client, 'notification', _stream_online('rerun')) == 200
+        assert fake.notifications == []
+
+    run(test())
+
+
+def test_notifications_with_invalid_signature_are_rejected(run, monkeypatch):
+    fake = FakeTwitch(monkeypatch)
+
+    async def test():
+        async with fake as client:
+            body, headers = _message('notification', _stream_online())
+            headers['Twitch-Eventsub-Message-Signature'] = 'sha256=' + '0' * 64
+            async with client.post('/eventsub', data=body, headers=headers) as resp:
+                assert resp.status == 400
+            await asyncio.sleep(0)
+        assert fake.notifications == []
+
+    run(test())
+
+
+def test_revocation_forgets_the_subscription(run, monkeypatch):
+    fake = FakeTwitch(monkeypatch)
+
+    async def test():
+        async with fake as client:
+            payload = {'subscription': _subscription('authorization_revoked')}
+            assert await _post(client, 'revocation', payload) == 200
+        assert twitch._EVENTSUB_SUBSCRIPTIONS == {}
+
+    run(test())
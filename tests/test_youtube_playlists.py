@@ -0,0 +1,123 @@
+import hashlib
+import json
+
+from aiohttp import test_utils, web
+
+from snoozybot.discord_bot.commands import youtube
+
+
+class FakeYoutubeApi:
+    """The playlistItems endpoint of the youtube API over playlists of (item id, privacy status), with page ETags."""
+
+    def __init__(self, page_size: int = 2) -> None:
+        self.playlists: dict[str, list[tuple[str, str]]] = {}
+        self.page_size = page_size
+        self.requests: list[tuple[str, int]] = []  # playlist id and status of each request
+        self._server: test_utils.TestServer | None = None
+
+    async def __aenter__(self) -> 'FakeYoutubeApi':
+        app = web.Application()
+        app.router.add_get('/playlistItems', self._playlist_items)
+        self._server = test_utils.TestServer(app)
+        await self._server.start_server()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        if self._server:
+            await self._server.close()
+
+    @property
+    def url(self) -> str:
+        assert self._server
+        return str(self._server.make_url('/'))
+
+    async def _playlist_items(self, request: web.Request) -> web.Response:
+        playlist_id = request.query['playlistId']
+        start = int(request.query.get('pageToken') or 0)
+        items = self.playlists[playlist_id]
+        page: dict = {'items': [{'id': item_id, 'status': {'privacyStatus': status}}
+                                for item_id, status in items[start:start + self.page_size]]}
+        if start + self.page_size < len(items):
+            page['nextPageToken'] = str(start + self.page_size)
+        page['etag'] = hashlib.sha1(json.dumps(page).encode()).hexdigest()  # noqa: S324
+        status = 304 if request.headers.get('If-None-Match') == page['etag'] else 200
+        self.requests.append((playlist_id, status))
+        return web.Response(status=304) if status == 304 else web.json_response(page)
+
+
+def _public(*item_ids: str) -> list[tuple[str, str]]:
+    return [(item_id, 'public') for item_id in item_ids]
+
+
+async def _poll(playlist_id: str, state: youtube.PlaylistState | None) -> tuple[list[str], youtube.PlaylistState]:
+    client = youtube.Youtube()
+    client.set_api_key('api-key')
+    return await client.get_new_playlist_videos(playlist_id, state)
+
+
+def test_uploads_playlist_is_read_until_the_first_known_video(run, monkeypatch):
+    async def test():
+        async with FakeYoutubeApi() as api:
+            monkeypatch.setattr(youtube, '_API_URL', api.url)
+            api.playlists['UU1'] = _public('c', 'b', 'a')
+            new_ids, state = await _poll('UU1', None)
+            assert new_ids == []
+            assert state.recent_item_ids == ['c', 'b']
+
+            api.playlists['UU1'] = _public('f', 'e', 'd', 'c', 'b', 'a')
+            api.requests.clear()
+            new_ids, state = await _poll('UU1', state)
+            assert new_ids == ['f', 'e', 'd']
+            assert len(api.requests) == 2  # stopped at the page with a known video
+
+            api.requests.clear()
+            new_ids, unchanged = await _poll('UU1', state)
+            assert new_ids == []
+            assert unchanged == state
+            assert api.requests == [('UU1', 304)]
+
+    run(test())
+
+
+def test_uploads_playlist_without_known_videos_is_reset(run, monkeypatch):
+    async def test():
+        async with FakeYoutubeApi() as api:
+            monkeypatch.setattr(youtube, '_API_URL', api.url)
+            api.playlists['UU1'] = _public('b', 'a')
+            _, state = await _poll('UU1', None)
+            api.playlists['UU1'] = _public('d', 'c')
+            new_ids, state = await _poll('UU1', state)
+            assert new_ids == []
+            assert state.recent_item_ids == ['d', 'c']
+
+    run(test())
+
+
+def test_other_playlist_finds_videos_added_at_the_end(run, monkeypatch):
+    async def test():
+        async with FakeYoutubeApi() as api:
+            monkeypatch.setattr(youtube, '_API_URL', api.url)
+            api.playlists['PL1'] = _public('a', 'b', 'c')
+            new_ids, state = await _poll('PL1', None)
+            assert new_ids == []
+            api.playlists['PL1'] = _public('a', 'b', 'c', 'd', 'e')
+            new_ids, state = await _poll('PL1', state)
+            assert new_ids == ['d', 'e']
+            new_ids, _ = await _poll('PL1', state)
+            assert new_ids == []
+
+    run(test())
+
+
+def test_other_playlist_finds_videos_made_public_between_known_ones(run, monkeypatch):
+    async def test():
+        async with FakeYoutubeApi() as api:
+            monkeypatch.setattr(youtube, '_API_URL', api.url)
+            api.playlists['PL1'] = [('a', 'public'), ('b', 'private'), ('c', 'public'), ('d', 'public')]
+            _, state = await _poll('PL1', None)
+            assert state.recent_item_ids == ['a', 'c', 'd']
+            api.playlists['PL1'] = _public('a', 'b', 'c', 'd')
+            new_ids, _ = await _poll('PL1', state)
+            assert new_ids == ['b']
+
+    run(test())
@@ -0,0 +1,171 @@
+import asyncio
+import hmac
+from datetime import datetime, timedelta
+
+import aiohttp
+import pytest
+from aiohttp import test_utils, web
+
+from snoozybot.discord_bot.commands import youtube
+from snoozybot.http_client import http_client
+
+SECRET = 'hunter2'
+
+
+class FakeHub:
+    """A WebSub hub that verifies each (un)subscription with the callback before answering the request."""
+
+    def __init__(self, lease_seconds: int = 5 * 86400, fail_channels: frozenset[str] = frozenset()) -> None:
+        self.lease_seconds = lease_seconds
+        self.fail_channels = fail_channels
+        self.requests: list[tuple[str, str]] = []
+        self.verifications: list[tuple[int, str]] = []
+        self.url = ''
+        self._runner: web.AppRunner | None = None
+
+    async def __aenter__(self) -> 'FakeHub':
+        app = web.Application()
+        app.router.add_post('/subscribe', self._subscribe)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        port = test_utils.unused_port()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+        self.url = f'http://127.0.0.1:{port}/subscribe'
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _subscribe(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        channel_id = form['hub.topic'].removeprefix(youtube._WEBSUB_TOPIC)
+        self.requests.append((form['hub.mode'], channel_id))
+        if channel_id in self.fail_channels:
+            return web.Response(status=400)
+        async with http_client.session.get(form['hub.callback'], params={
+            'hub.mode': form['hub.mode'], 'hub.topic': form['hub.topic'], 'hub.challenge': 'challenge-' + channel_id,
+            'hub.lease_seconds': str(self.lease_seconds),
+        }) as resp:
+            self.verifications.append((resp.status, await resp.text()))
+        return web.Response(status=202)
+
+
+@pytest.fixture
+def websub() -> tuple[youtube.YoutubeWebSub, list[str], int]:
+    uploads: list[str] = []
+
+    async def on_upload(channel_id: str) -> None:
+        uploads.append(channel_id)
+
+    port = test_utils.unused_port()
+    return youtube.YoutubeWebSub(f'http://127.0.0.1:{port}/websub', SECRET, on_upload), uploads, port
+
+
+def test_subscribe_is_verified_with_the_hubs_lease(run, monkeypatch, websub):
+    receiver, _, port = websub
+
+    async def test():
+        async with FakeHub(lease_seconds=3600) as hub:
+            monkeypatch.setattr(youtube, '_WEBSUB_HUB', hub.url)
+            await receiver.start(port)
+            try:
+                await receiver.sync({'UC1'})
+            finally:
+                await receiver.stop()
+        assert hub.verifications == [(200, 'challenge-UC1')]
+        lease = receiver._leases['UC1'] - datetime.now()
+        assert timedelta(minutes=59) < lease <= timedelta(hours=1)
+
+    run(test())
+
+
+def test_failed_subscribe_is_retried_and_does_not_stop_the_others(run, monkeypatch, websub):
+    receiver, _, port = websub
+
+    async def test():
+        async with FakeHub(fail_channels=frozenset({'UC1'})) as hub:
+            monkeypatch.setattr(youtube, '_WEBSUB_HUB', hub.url)
+            await receiver.start(port)
+            try:
+                await receiver.sync({'UC1', 'UC2'})
+                assert receiver._leases.keys() == {'UC2'}
+                await receiver.sync({'UC1', 'UC2'})
+            finally:
+                await receiver.stop()
+        assert hub.requests.count(('subscribe', 'UC1')) == 2
+        assert hub.requests.count(('subscribe', 'UC2')) == 1
+
+    run(test())
+
+
+def test_unsubscribe_is_verified(run, monkeypatch, websub):
+    receiver, _, port = websub
+
+    async def test():
+        async with FakeHub() as hub:
+            monkeypatch.setattr(youtube, '_WEBSUB_HUB', hub.url)
+            await receiver.start(port)
+            try:
+                await receiver.sync({'UC1'})
+                await receiver.sync(set())
+            finally:
+                await receiver.stop()
+        assert hub.requests == [('subscribe', 'UC1'), ('unsubscribe', 'UC1')]
+        assert hub.verifications == [(200, 'challenge-UC1'), (200, 'challenge-UC1')]
+        assert not receiver._leases
+
+    run(test())
+
+
+def test_verification_of_unknown_subscription_is_refused(run, websub):
+    receiver, _, port = websub
+
+    async def test():
+        await receiver.start(port)
+        try:
+            async with http_client.session.get(f'http://127.0.0.1:{port}/websub', params={
+                'hub.mode': 'subscribe', 'hub.topic': youtube._WEBSUB_TOPIC + 'UC1', 'hub.challenge': 'x',
+            }) as resp:
+                assert resp.status == 404
+        finally:
+            await receiver.stop()
+        assert not receiver._leases
+
+    run(test())
+
+
+@pytest.mark.parametrize('signature, expected_uploads', [
+    (lambda body: 'sha1=' + hmac.new(SECRET.encode(), body, 'sha1').hexdigest(), ['UC1']),
+    (lambda body: 'sha1=' + hmac.new(b'wrong', body, 'sha1').hexdigest(), []),
+    (lambda body: '', []),
+])
+def test_notifications_are_checked_against_the_secret(run, websub, signature, expected_uploads):
+    receiver, uploads, port = websub
+    body = b'<feed><entry><yt:videoId>v</yt:videoId><yt:channelId>UC1</yt:channelId></entry></feed>'
+
+    async def test():
+        await receiver.start(port)
+        try:
+            async with http_client.post(f'http://127.0.0.1:{port}/websub', data=body, headers={
+                'X-Hub-Signature': signature(body), 'Content-Type': 'application/atom+xml',
+            }) as resp:
+                assert resp.status == 204  # acknowledged either way, so the hub doesn't retry
+            await asyncio.sleep(0)  # let the upload task run
+        finally:
+            await receiver.stop()
+        assert uploads == expected_uploads
+
+    run(test())
+
+
+def test_hub_errors_are_raised_by_requests(run, monkeypatch, websub):
+    receiver, _, _ = websub
+
+    async def test():
+        async with FakeHub(fail_channels=frozenset({'UC1'})) as hub:
+            monkeypatch.setattr(youtube, '_WEBSUB_HUB', hub.url)
+            with pytest.raises(aiohttp.ClientResponseError):
+                await receiver._request('subscribe', 'UC1')
+
+    run(test())